@@ -1,107 +1,303 @@
 import os
 import json
+import hashlib
 import cv2
 import numpy as np
 import base64
 import requests
-import time
 import math
 import uuid
+import struct
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 from flask import Flask, render_template, request, jsonify, redirect, url_for, session
 from datetime import datetime, timedelta, timezone
 from apscheduler.schedulers.background import BackgroundScheduler
 
 # --- SECURITY DEPENDENCIES ---
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# --- NEW: FaceNet Dependency (lazy, lihat vision.py) ---
+from vision import FaceVision, VisionUnavailable, VisionBusy
+from face_gallery import FaceGallery
+from gallery_file import GalleryFile
+from face_detection import FaceDetector, FACE_SIZE
+from storage import Storage
+from users import UserRepository
+from knowledge import KnowledgeLoader
+from enrollment import EnrollmentStore, robust_centroid, select_templates
+from embedding_cache import EmbeddingCache
+from face_stream import LatestFrameSlot, LoginTokenStore, LoginVoter
+from session_store import ServerSessionInterface, MemorySessionBackend, SQLiteSessionBackend
+
+# --- OPTIONAL: WebSocket face login (pip install flask-sock) ---
+try:
+    from flask_sock import Sock
+except ImportError:
+    Sock = None
 
-# --- NEW: FaceNet Dependency ---
-from keras_facenet import FaceNet
-from sklearn.metrics.pairwise import cosine_similarity
 app = Flask(__name__)
 app.secret_key = 'healthguard_secret_key_secure_random_string'
 
+# Tanpa flask-sock, auth.html otomatis balik ke polling /api/login_face
+sock = Sock(app) if Sock is not None else None
+
 # --- INITIALIZE SCHEDULER ---
-scheduler = BackgroundScheduler()
-scheduler.start()
+scheduler = BackgroundScheduler()   # Di-start di init_app()
 
 # --- CONFIGURATION ---
 DB_FILE = 'database.json'
+SQLITE_FILE = 'healthguard.db'
 FACE_DATA_DIR = 'face_data'
 HaarPath = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
-face_cascade = cv2.CascadeClassifier(HaarPath)
 
-# --- LOAD ML MODEL (FACENET) ---
-print("[SYSTEM] Loading FaceNet (State-of-the-art Face Recognition)...")
-# Ini akan mendownload model FaceNet sekali saja (sekitar 90MB)
-embedder = FaceNet()
-print("[SYSTEM] FaceNet Loaded. AI Vision System Active.")
+# Deteksi wajah cepat: Haar jalan di salinan kecil (lebar FACE_DETECT_WIDTH) lalu kotaknya
+# di-scale balik; frame login berikutnya dari browser yang sama dicari dulu di sekitar kotak lama
+FACE_DETECT_FAST = True
+FACE_DETECT_WIDTH = 320
+FACE_MAX_INPUT_SIDE = 1280   # Frame lebih besar dari ini di-resize dulu
+face_detector = FaceDetector(HaarPath, fast=FACE_DETECT_FAST, detect_width=FACE_DETECT_WIDTH,
+                             max_input_side=FACE_MAX_INPUT_SIDE)
+
+# Face search: 'exact' (brute force) atau 'ivf' (approximate, buat gallery jutaan user)
+FACE_SEARCH_MODE = 'exact'
+FACE_IVF_NPROBE = 8          # Recall vs latency knob: cluster yang discan per query
+FACE_IVF_MIN_SIZE = 10000    # Di bawah ini tetap brute force
+
+# Template wajah per user: 1 = satu centroid (default). >1 = simpan K template multi-angle
+FACE_TEMPLATES_PER_USER = 1
+FACE_TEMPLATE_METHOD = 'kmeans'  # 'kmeans' atau 'fps' (farthest-point sampling)
+FACE_TEMPLATE_FUSION = 'max'     # 'max' atau 'mean_top' (rata-rata 2 template terbaik)
+
+# Format gallery di memori: 'float32', 'float16' (1/2 memori) atau 'int8' (1/4 memori, scale per row).
+# FACE_GALLERY_RERANK > 0: top (rerank x k) hasil quantized dihitung ulang pakai float32.
+FACE_GALLERY_DTYPE = 'float32'
+FACE_GALLERY_RERANK = 0
+
+# Semua template wajah di satu file append-only yang di-memmap (page cache dipakai bareng semua worker),
+# bukan satu .npy per user. File .npy lama otomatis dimigrasi. None -> balik ke satu .npy per user.
+FACE_GALLERY_FILE = os.path.join(FACE_DATA_DIR, 'gallery.bin')
+
+# Vision stack: HEALTHGUARD_VISION=0 buat worker chat/directory saja (FaceNet gak pernah di-load).
+# HEALTHGUARD_VISION_WARMUP=1 -> model di-load di background thread waktu startup.
+VISION_ENABLED = os.environ.get('HEALTHGUARD_VISION', '1') == '1'
+VISION_WARMUP = os.environ.get('HEALTHGUARD_VISION_WARMUP', '1') == '1'
+
+# Backend embedding: 'thread' (FaceNet di proses ini), 'process' (pool worker process,
+# tiap worker punya FaceNet sendiri) atau 'remote' (service terpisah via UNIX socket)
+FACE_EMBED_BACKEND = os.environ.get('HEALTHGUARD_EMBED_BACKEND', 'thread')
+FACE_EMBED_WORKERS = 2
+FACE_EMBED_QUEUE_SIZE = 64    # Antrian penuh -> 503 (backpressure), bukan numpuk
+FACE_EMBED_TIMEOUT = 5.0      # Detik
+
+# Cache embedding per crop wajah (LRU + TTL), key = perceptual hash (dHash) crop 160x160.
+# FACE_EMBED_CACHE_SIZE = 0 -> cache mati
+FACE_EMBED_CACHE_SIZE = 1024
+FACE_EMBED_CACHE_TTL = 5.0    # Detik
+
+# Micro-batching FaceNet: frame dari request yang barengan dijadikan satu forward pass
+FACE_BATCH_SIZE = 16
+FACE_BATCH_WAIT_MS = 5
+
+# Login wajah
+FACE_LOGIN_THRESHOLD = 0.75
+FACE_STREAM_MAX_SECONDS = 10    # Koneksi streaming ditutup kalau belum match
+FACE_LOGIN_TOKEN_TTL = 30
+
+# Mode login: 'single' (putusan per frame) atau 'vote' (gabungan beberapa frame terakhir per sesi scan).
+# Di mode vote satu frame > FACE_LOGIN_THRESHOLD tetap langsung lolos; selain itu user lolos kalau
+# minimal FACE_VOTE_MIN_FRAMES dari FACE_VOTE_WINDOW frame terakhir cocok ke user yang SAMA dengan
+# skor > FACE_VOTE_FRAME_THRESHOLD. Threshold per frame lebih rendah, tapi harus konsisten beberapa frame.
+# Frame yang kotak wajahnya hampir gak berubah gak di-embed ulang (gak bisa dipakai nambah vote).
+FACE_LOGIN_MODE = 'single'
+FACE_VOTE_WINDOW = 5
+FACE_VOTE_MIN_FRAMES = 3
+FACE_VOTE_FRAME_THRESHOLD = 0.65
+FACE_VOTE_CANDIDATES = 3      # Kandidat gallery yang dicatat per frame
+FACE_VOTE_SKIP_IOU = 0.9
+
+# Upload frame: JSON base64 (lama), JPEG mentah (image/jpeg / application/octet-stream),
+# atau crop wajah RGB 160x160 uint8 yang sudah jadi (header X-Frame-Format: rgb160)
+FACE_ACCEPT_TENSORS = True
+FACE_MAX_UPLOAD_BYTES = 4 * 1024 * 1024
+
+# Batch enrollment: decode + Haar detection jalan paralel (OpenCV melepas GIL)
+ENROLL_MAX_FRAMES_PER_REQUEST = 64
+ENROLL_MAX_FRAME_BYTES = 512 * 1024          # Per frame JPEG
+ENROLL_MAX_BATCH_BYTES = 8 * 1024 * 1024     # Per request (body total)
+frame_pool = ThreadPoolExecutor(max_workers=4)
+
+# Batas body semua request; lebih besar dari ini langsung 413 sebelum dibaca
+app.config['MAX_CONTENT_LENGTH'] = max(FACE_MAX_UPLOAD_BYTES, ENROLL_MAX_BATCH_BYTES)
+# Sama untuk frame WebSocket: pesan yang lebih besar bikin koneksi ditutup (1009)
+app.config['SOCK_SERVER_OPTIONS'] = {'max_message_size': FACE_MAX_UPLOAD_BYTES}
+
+# Buffer enrollment per sesi registrasi (in-memory, TTL). Isi ENROLL_SPILL_DIR kalau
+# jalan multi-process supaya finalize bisa dilayani worker mana pun.
+ENROLL_MAX_FRAMES = 128
+ENROLL_TTL_SECONDS = 600
+ENROLL_MAX_SESSIONS = 256      # Buffer in-memory paling banyak segini (LRU)
+ENROLL_SPILL_DIR = None
+
+# Session Flask (user_id, chat_state, symptoms, dst.) disimpan di server, cookie cuma bawa session id.
+# 'sqlite' (default, dipakai bareng semua worker + tahan restart), 'memory' (LRU in-process, satu worker saja)
+# atau 'cookie' (signed cookie bawaan Flask seperti dulu)
+SESSION_BACKEND = 'sqlite'
+SESSION_TTL_SECONDS = 7 * 24 * 3600
+SESSION_MAX_ENTRIES = 10000   # Khusus backend 'memory'
+
+# Listing dokter: tanpa 'limit' semua hasil dikirim seperti dulu; 'limit' dibatasi DOCTOR_PAGE_MAX
+DOCTOR_PAGE_MAX = 100
+
+# --- ML MODEL (FACENET) ---
+# Di-load saat pertama dipakai (atau warm-up di init_app()), bukan waktu import
+vision = FaceVision(enabled=VISION_ENABLED, batch_size=FACE_BATCH_SIZE, batch_wait_ms=FACE_BATCH_WAIT_MS,
+                    backend=FACE_EMBED_BACKEND, workers=FACE_EMBED_WORKERS,
+                    queue_size=FACE_EMBED_QUEUE_SIZE, timeout=FACE_EMBED_TIMEOUT)
+embedding_cache = EmbeddingCache(max_size=FACE_EMBED_CACHE_SIZE, ttl=FACE_EMBED_CACHE_TTL)
+
+# --- SHARED STATE ---
+# Diisi init_app(): store, users, knowledge, gallery_file, login_tokens (lihat STARTUP)
+store = None
+users = None
+knowledge = None
+gallery_file = None
+login_tokens = None
+
+login_voter = LoginVoter(window=FACE_VOTE_WINDOW, frame_threshold=FACE_VOTE_FRAME_THRESHOLD,
+                         skip_iou=FACE_VOTE_SKIP_IOU)
+
+enrollments = EnrollmentStore(max_frames=ENROLL_MAX_FRAMES, ttl=ENROLL_TTL_SECONDS, spill_dir=ENROLL_SPILL_DIR,
+                              max_sessions=ENROLL_MAX_SESSIONS)
+
+# --- FACE GALLERY INDEX ---
+# Semua embedding wajah dimuat sekali ke satu matrix, jadi login gak perlu np.load per user
+face_gallery = FaceGallery(search_mode=FACE_SEARCH_MODE, n_probe=FACE_IVF_NPROBE, min_ivf_size=FACE_IVF_MIN_SIZE,
+                           fusion=FACE_TEMPLATE_FUSION, dtype=FACE_GALLERY_DTYPE, rerank=FACE_GALLERY_RERANK)
+
+# --- STARTUP ---
+# Semua efek samping (scheduler, migrasi JSON -> SQLite, load knowledge & gallery, warm-up FaceNet)
+# ada di sini, bukan di level modul: worker FaceNet backend 'process' di-spawn dan meng-import ulang
+# modul ini sebagai __mp_main__, jadi import app.py harus bebas efek samping.
+# python app.py memanggilnya sendiri; WSGI server: gunicorn 'app:init_app()'
+_initialized = False
+
+def init_app():
+    global store, users, knowledge, gallery_file, login_tokens, _initialized
+    if _initialized: return app
+    _initialized = True
+
+    scheduler.start()
+
+    # Session Flask disimpan di server, cookie cuma bawa session id
+    if SESSION_BACKEND == 'sqlite':
+        app.session_interface = ServerSessionInterface(SQLiteSessionBackend(SQLITE_FILE, ttl=SESSION_TTL_SECONDS))
+    elif SESSION_BACKEND == 'memory':
+        app.session_interface = ServerSessionInterface(MemorySessionBackend(ttl=SESSION_TTL_SECONDS,
+                                                                            max_entries=SESSION_MAX_ENTRIES))
+
+    # Data user, chat, reminder & appointment disimpan di SQLite (WAL), bukan database.json lagi
+    store = Storage(SQLITE_FILE)
+    store.migrate_from_json(DB_FILE)
+    # Lookup user by id/email/phone dari hash index in-memory, sinkron ke DB paling banyak sekali per request
+    users = UserRepository(store)
+    # Token login streaming di SQLite juga, jadi bisa ditukar di worker mana pun
+    login_tokens = LoginTokenStore(SQLITE_FILE, ttl=FACE_LOGIN_TOKEN_TTL)
+
+    # medical_knowledge (ditulis db_setup.py) dimuat sekali, read-only, auto reload kalau file berubah
+    knowledge = KnowledgeLoader(DB_FILE)
+
+    if VISION_ENABLED:
+        if FACE_GALLERY_FILE:
+            if not os.path.exists(FACE_DATA_DIR): os.makedirs(FACE_DATA_DIR)
+            gallery_file = GalleryFile(FACE_GALLERY_FILE)
+            # User yang masih punya file .npy sendiri dimasukkan sekali ke gallery.bin
+            gallery_file.migrate_users(store.list_users())
+            face_gallery.load_file(gallery_file)
+        else:
+            face_gallery.load_users(store.list_users())
+
+    if VISION_WARMUP: vision.warm_up()
+    return app
 
 # --- HELPER FUNCTIONS ---
-def load_db():
-    if not os.path.exists(DB_FILE):
-        return {"users": [], "chat_sessions": [], "medical_knowledge": {}, "reminders": [], "appointments": []}
-    with open(DB_FILE, 'r') as f:
-        try:
-            data = json.load(f)
-        except json.JSONDecodeError:
-            return {"users": [], "chat_sessions": [], "medical_knowledge": {}, "reminders": [], "appointments": []}
-            
-        if "reminders" not in data:
-            data["reminders"] = []
-        if "appointments" not in data:
-            data["appointments"] = []
-        return data
+def preprocess_face(frame, client_id=None, max_side=None):
+    # Hasilnya crop wajah RGB 160x160 (FaceNet butuh RGB, bukan BGR)
+    return face_detector.preprocess(frame, client_id=client_id, max_side=max_side)
 
-def save_db(data):
-    with open(DB_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
+def embed_face(face, client_id=None):
+    # Crop yang (hampir) identik dari client yang sama -> dHash sama -> embedding diambil dari cache,
+    # FaceNet gak dipanggil. Cache per client: dHash dua orang bisa tabrakan.
+    return embedding_cache.embed(face, vision.embed, scope=client_id)
 
-def preprocess_face(frame):
-    # FaceNet butuh input RGB, bukan BGR (OpenCV default BGR)
-    rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=3, minSize=(30, 30))
-    
-    if len(faces) == 0: return None, False
-    
-    (x, y, w, h) = max(faces, key=lambda b: b[2] * b[3])
-    
-    # FaceNet butuh margin sedikit supaya dagu/jidat gak kepotong
-    padding = 10
-    face_roi = rgb_frame[max(0, y-padding):y+h+padding, max(0, x-padding):x+w+padding]
-    
-    # FaceNet standar inputnya 160x160 pixels
-    try:
-        face_roi = cv2.resize(face_roi, (160, 160))
-    except:
-        return None, False
-        
-    return face_roi, True
-
-def get_face_embedding(frame):
-    processed_face, found = preprocess_face(frame)
+def get_face_embedding(frame, client_id=None):
+    processed_face, found = preprocess_face(frame, client_id)
     if not found: return None
     
-    # keras-facenet butuh array 4 dimensi: (1, 160, 160, 3)
-    face_array = np.expand_dims(processed_face, axis=0)
-    
-    # Fungsi ini otomatis melakukan normalisasi dan ekstraksi fitur
-    embeddings = embedder.embeddings(face_array)
-    
-    # Kembalikan vektor embedding pertama (panjang 512)
-    return embeddings[0]
+    # Masuk antrian batch; keras-facenet dipanggil dengan array (N, 160, 160, 3)
+    # dan fungsi itu otomatis melakukan normalisasi dan ekstraksi fitur.
+    # Hasilnya vektor embedding milik frame ini saja (panjang 512)
+    return embed_face(processed_face, client_id)
+
+def read_face_upload():
+    """Returns (frame, face): a decoded BGR frame, or a ready RGB face crop when the client sent one."""
+    if request.content_length and request.content_length > FACE_MAX_UPLOAD_BYTES:
+        raise ValueError("Frame too large")
+    if request.is_json:
+        # Format lama: {"image": "data:image/jpeg;base64,..."}
+        header, encoded = request.json['image'].split(",", 1)
+        data = base64.b64decode(encoded)
+    else:
+        # Body mentah dibaca langsung dari stream, np.frombuffer tanpa copy
+        data = request.get_data(cache=False)
+
+    if request.headers.get('X-Frame-Format') == 'rgb160':
+        if not FACE_ACCEPT_TENSORS or len(data) != FACE_SIZE * FACE_SIZE * 3:
+            raise ValueError("Invalid face tensor")
+        return None, np.frombuffer(data, np.uint8).reshape(FACE_SIZE, FACE_SIZE, 3)
+
+    frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if frame is None: raise ValueError("Could not decode image")
+    return frame, None
+
+def get_upload_embedding(client_id=None):
+    frame, face = read_face_upload()
+    if face is not None:
+        # Client sudah crop wajahnya sendiri, Haar detection dilewati
+        return embed_face(face, client_id)
+    return get_face_embedding(frame, client_id)
+
+def requires_vision(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not vision.enabled:
+            return jsonify({"status": "error", "message": "Face recognition is not available on this server"}), 503
+        try:
+            return view(*args, **kwargs)
+        except VisionBusy:
+            return jsonify({"status": "busy", "message": "Face recognition is busy, please retry"}), 503, {"Retry-After": "1"}
+        except VisionUnavailable as e:
+            return jsonify({"status": "error", "message": f"Face recognition unavailable: {e}"}), 503
+    return wrapper
+
+def start_user_session(user_id):
+    # Ganti session id tiap ganti hak akses (login/registrasi), cegah session fixation.
+    # Backend 'cookie' gak punya regenerate(): isinya memang ikut ditandatangani ulang.
+    if hasattr(session, 'regenerate'): session.regenerate()
+    session['user_id'] = user_id
+
+def end_user_session():
+    session.clear()
+    if hasattr(session, 'regenerate'): session.regenerate()
 
 def verify_session_validity():
     if 'user_id' in session:
-        db = load_db()
-        user_exists = False
-        for user in db.get('users', []):
-            if user['id'] == session['user_id']:
-                user_exists = True
-                break
+        user_exists = users.get(session['user_id']) is not None
         if not user_exists:
-            session.clear()
+            end_user_session()
             return False
         return True
     return False
@@ -131,11 +327,9 @@ def home():
     verify_session_validity()
     user_name = None
     if 'user_id' in session:
-        db = load_db()
-        for user in db['users']:
-            if user['id'] == session['user_id']:
-                user_name = user['name']
-                break
+        user = users.get(session['user_id'])
+        if user:
+            user_name = user['name']
     
     services = [
         {"title": "Deep Symptom Analysis", "desc": "Check multiple body locations (Head, Stomach, Limbs) for a comprehensive diagnosis.", "icon": "fa-stethoscope"},
@@ -153,28 +347,22 @@ def auth_page():
 
 @app.route('/logout')
 def logout():
-    session.clear()
+    end_user_session()
     return redirect(url_for('home'))
 
 @app.route('/profile')
 def profile_page():
     if not verify_session_validity(): return redirect(url_for('auth_page'))
     
-    db = load_db()
     user_id = session['user_id']
-    current_user = None
-    
-    for user in db['users']:
-        if user['id'] == user_id:
-            current_user = user
-            break
+    current_user = users.get(user_id)
             
     if not current_user:
         return redirect(url_for('logout'))
 
     # Get User Data
-    user_reminders = [r for r in db.get('reminders', []) if r['user_id'] == user_id]
-    user_appointments = [a for a in db.get('appointments', []) if a['user_id'] == user_id]
+    user_reminders = store.list_reminders(user_id)
+    user_appointments = store.list_appointments(user_id)
 
     # Dummy Health Stats
     dummy_stats = {
@@ -193,20 +381,15 @@ def chat_page():
     if not verify_session_validity(): return redirect(url_for('auth_page'))
     if 'user_id' not in session: return redirect(url_for('auth_page'))
     
-    db = load_db()
     user_name = "User"
     user_id = session['user_id']
     
-    for user in db['users']:
-        if user['id'] == user_id:
-            user_name = user['name']
-            break
+    user = users.get(user_id)
+    if user:
+        user_name = user['name']
             
-    # Load User's Chat History
-    all_sessions = db.get('chat_sessions', [])
-    # Filter only this user's sessions and sort by newest first
-    user_history = [s for s in all_sessions if s['user_id'] == user_id]
-    user_history.reverse() # Newest on top
+    # Load User's Chat History (newest on top)
+    user_history = store.list_chat_sessions(user_id)
     
     # Initialize default state for a new chat
     session['chat_state'] = 'start'
@@ -222,22 +405,30 @@ def chat_page():
 def doctors_page():
     if not verify_session_validity(): return redirect(url_for('auth_page'))
     
-    db = load_db()
     user_name = "User"
-    user_id = session['user_id']
-    for user in db['users']:
-        if user['id'] == user_id:
-            user_name = user['name']
-            break
+    user = users.get(session['user_id'])
+    if user:
+        user_name = user['name']
             
-    # Get all doctors to pass unique specialties to the filter
-    doctors = db['medical_knowledge'].get('doctors', [])
-    specialties = sorted(list(set(d['specialty'] for d in doctors)))
+    # Unique specialties for the filter (precomputed in the knowledge base)
+    specialties = knowledge.get().specialties
     
     return render_template('doctors.html', user_name=user_name, specialties=specialties)
 
 # --- API ENDPOINTS ---
 
+# --- VISION READINESS ---
+@app.route('/api/vision/status')
+def vision_status():
+    info = vision.status()
+    info["gallery_size"] = len(face_gallery)
+    info["streaming_login"] = sock is not None
+    info["login_mode"] = FACE_LOGIN_MODE
+    info["embed_cache"] = embedding_cache.stats()
+    if FACE_LOGIN_MODE == 'vote':
+        info.update(login_voter.stats())
+    return jsonify(info), (200 if vision.ready else 503)
+
 # --- APPOINTMENT ENDPOINTS ---
 @app.route('/api/appointments/book', methods=['POST'])
 def book_appointment():
@@ -248,7 +439,6 @@ def book_appointment():
         
         # 2. Load Data
         data = request.json
-        db = load_db()
         
         # 3. Create Appointment Object
         new_appointment = {
@@ -266,11 +456,7 @@ def book_appointment():
         }
         
         # 4. Save to Database
-        if "appointments" not in db: 
-            db["appointments"] = []
-            
-        db["appointments"].append(new_appointment)
-        save_db(db) # This writes to database.json
+        store.add_appointment(new_appointment)
         
         return jsonify({"status": "success", "message": "Appointment booked successfully!"})
 
@@ -286,52 +472,106 @@ def cancel_appointment():
     appoint_id = data.get('appointment_id')
     user_id = session['user_id']
     
-    db = load_db()
-    
-    if "appointments" not in db: return jsonify({"status": "error", "message": "No appointments found"})
-    
-    original_len = len(db["appointments"])
     # Remove appointment
-    db["appointments"] = [a for a in db["appointments"] if not (a['id'] == appoint_id and a['user_id'] == user_id)]
-    
-    if len(db["appointments"]) < original_len:
-        save_db(db)
+    if store.delete_appointment(appoint_id, user_id):
         return jsonify({"status": "success", "message": "Appointment cancelled."})
     else:
         return jsonify({"status": "error", "message": "Appointment not found."})
 
+# --- DOCTOR LISTING (pagination, fields, ETag) ---
+# Dipakai /api/doctors/search dan /api/doctors/get_by_specialty. Parameter bisa lewat JSON body (POST)
+# atau query string (GET, di-revalidate browser pakai If-None-Match):
+#   limit, offset / cursor, fields (list atau "name,price"). Respon selalu bawa 'total'.
+class ListingError(ValueError):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def listing_params():
+    if request.method == 'GET':
+        return request.args
+    return request.get_json(silent=True) or {}
+
+def _int_param(data, name, default):
+    value = data.get(name)
+    if value is None or value == '': return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ListingError(f"'{name}' must be an integer")
+    if value < 0: raise ListingError(f"'{name}' must not be negative")
+    return value
+
+def encode_cursor(version, offset):
+    return base64.urlsafe_b64encode(f"{version}:{offset}".encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, version):
+    try:
+        cursor_version, offset = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().rsplit(':', 1)
+        # Cursor bisa dipalsukan: offset harus bilangan bulat >= 0, sama seperti param 'offset'
+        if not offset.isdigit(): raise ValueError(offset)
+        offset = int(offset)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ListingError("Invalid cursor")
+    if cursor_version != version:
+        # Direktori dokter berubah (db_setup.py jalan lagi): urutan lama gak berlaku
+        raise ListingError("Doctor directory changed, start again from the first page", 409)
+    return offset
+
+def doctor_listing(kb, data, key, find_ids):
+    """
+    One page of doctors. find_ids() returns the ordered ids of every match and only
+    runs when the client's ETag is stale; the ETag is derived from the knowledge
+    version and the request parameters, so a 304 skips the search and serialization.
+    """
+    try:
+        limit = _int_param(data, 'limit', None)
+        offset = _int_param(data, 'offset', 0)
+        if data.get('cursor'): offset = decode_cursor(data['cursor'], kb.version)
+    except ListingError as e:
+        return jsonify({"status": "error", "message": str(e)}), e.status
+    if limit is not None: limit = min(limit, DOCTOR_PAGE_MAX)
+
+    fields = data.get('fields')
+    if isinstance(fields, str): fields = [f for f in fields.split(',') if f]
+    elif fields is not None and not isinstance(fields, list):
+        return jsonify({"status": "error", "message": "'fields' must be a list or a comma-separated string"}), 400
+    fields = [str(f) for f in fields] if fields else None
+
+    etag = hashlib.sha1(json.dumps([request.path, kb.version, key, limit, offset, fields],
+                                   sort_keys=True, default=str).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        ids = find_ids()
+        total = len(ids)
+        end = total if limit is None else min(total, offset + limit)
+        page = [kb.doctors[i] for i in ids[offset:end]]
+        if fields: page = [{f: d[f] for f in fields if f in d} for d in page]
+        response = jsonify({
+            "status": "success", "doctors": page, "total": total, "offset": offset, "limit": limit,
+            "next_cursor": encode_cursor(kb.version, end) if offset < end < total else None
+        })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 # --- DOCTOR SEARCH API ---
-@app.route('/api/doctors/search', methods=['POST'])
+@app.route('/api/doctors/search', methods=['GET', 'POST'])
 def search_doctors():
     if 'user_id' not in session: return jsonify({"status": "error"}), 401
     
-    data = request.json
-    query = data.get('query', '').lower()
+    data = listing_params()
+    query = data.get('query', '')
     specialty = data.get('specialty', 'All')
     sort_by = data.get('sort', 'rating')
+    fuzzy = data.get('fuzzy') in (True, 'true', '1')
     
-    db = load_db()
-    doctors = db['medical_knowledge'].get('doctors', [])
-    
-    # 1. Filter by Text (Name or Hospital)
-    filtered = [
-        d for d in doctors 
-        if (query in d['name'].lower() or query in d['hospital'].lower())
-    ]
-    
-    # 2. Filter by Specialty
-    if specialty != 'All':
-        filtered = [d for d in filtered if d['specialty'] == specialty]
-        
-    # 3. Sort
-    if sort_by == 'price_low':
-        filtered.sort(key=lambda x: x['price'])
-    elif sort_by == 'price_high':
-        filtered.sort(key=lambda x: x['price'], reverse=True)
-    else: # Default: Rating
-        filtered.sort(key=lambda x: x['rating'], reverse=True)
-        
-    return jsonify({"status": "success", "doctors": filtered})
+    # Index n-gram/token + bitmap specialty + urutan per sort key, dibangun sekali per versi
+    # knowledge base (lihat doctor_index.py); urutan hasil sama persis dengan scan + sort lama
+    kb = knowledge.get()
+    return doctor_listing(kb, data, [query, specialty, sort_by, fuzzy],
+                          lambda: kb.doctor_index.query(query, specialty, sort_by, fuzzy=fuzzy))
 
 @app.route('/api/profile/update', methods=['POST'])
 def update_profile():
@@ -339,24 +579,20 @@ def update_profile():
     
     data = request.json
     user_id = session['user_id']
-    db = load_db()
-    
-    user_found = False
-    for user in db['users']:
-        if user['id'] == user_id:
-            user['name'] = data.get('name', user['name'])
-            user['email'] = data.get('email', user['email'])
-            user['phone'] = data.get('phone', user['phone'])
-            
-            # --- SECURITY CHANGE ---
-            if data.get('password'):
-                user['password'] = generate_password_hash(data.get('password')) # <--- HASH IT
-            
-            user_found = True
-            break
-            
-    if user_found:
-        save_db(db)
+    user = users.get(user_id)
+    
+    if user:
+        changes = {
+            'name': data.get('name', user['name']),
+            'email': data.get('email', user['email']),
+            'phone': data.get('phone', user['phone'])
+        }
+        
+        # --- SECURITY CHANGE ---
+        if data.get('password'):
+            changes['password'] = generate_password_hash(data.get('password')) # <--- HASH IT
+        
+        users.update(user_id, **changes)
         return jsonify({"status": "success", "message": "Profile updated successfully"})
     else:
         return jsonify({"status": "error", "message": "User not found"})
@@ -371,19 +607,7 @@ def update_reminder():
     new_times = data.get('times', [])
     user_id = session['user_id']
     
-    db = load_db()
-    reminder_found = False
-    
-    if 'reminders' in db:
-        for r in db['reminders']:
-            if r['id'] == reminder_id and r['user_id'] == user_id:
-                r['instruction'] = new_instruction
-                r['times'] = new_times
-                reminder_found = True
-                break
-    
-    if reminder_found:
-        save_db(db)
+    if store.update_reminder(reminder_id, user_id, new_instruction, new_times):
         return jsonify({"status": "success", "message": "Reminder updated"})
     else:
         return jsonify({"status": "error", "message": "Reminder not found"})
@@ -396,16 +620,7 @@ def delete_reminder():
     reminder_id = data.get('reminder_id')
     user_id = session['user_id']
     
-    db = load_db()
-    
-    if 'reminders' not in db:
-        db['reminders'] = []
-        
-    initial_len = len(db['reminders'])
-    db['reminders'] = [r for r in db['reminders'] if not (r['id'] == reminder_id and r['user_id'] == user_id)]
-    
-    if len(db['reminders']) < initial_len:
-        save_db(db)
+    if store.delete_reminder(reminder_id, user_id):
         return jsonify({"status": "success"})
     else:
         return jsonify({"status": "error", "message": "Reminder not found"})
@@ -413,210 +628,324 @@ def delete_reminder():
 @app.route('/api/register_step1', methods=['POST'])
 def register_step1():
     data = request.json
-    db = load_db()
-    for user in db['users']:
-        if user['email'] == data['email']:
-            return jsonify({"status": "error", "message": "Email exists"}), 400
-    session['reg_data'] = data
+    if users.get_by_email(data['email']):
+        return jsonify({"status": "error", "message": "Email exists"}), 400
+    enrollments.discard(session.get('enroll_id'))
+    # Password langsung di-hash: plaintext gak pernah ikut tersimpan di session store
+    session['reg_data'] = {
+        "name": data['name'],
+        "email": data['email'],
+        "phone": data['phone'],
+        "password_hash": generate_password_hash(data['password'])
+    }
+    session['enroll_id'] = enrollments.start()
     return jsonify({"status": "success"})
 
 @app.route('/api/register_face_training', methods=['POST'])
+@requires_vision
 def register_face_training():
     if 'reg_data' not in session: return jsonify({"status": "error"}), 400
     try:
-        image_data = request.json['image']
-        header, encoded = image_data.split(",", 1)
-        data = base64.b64decode(encoded)
-        np_arr = np.frombuffer(data, np.uint8)
-        frame = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-        
-        embedding = get_face_embedding(frame)
+        if 'enroll_id' not in session: session['enroll_id'] = enrollments.start()
+        embedding = get_upload_embedding(session['enroll_id'])
         if embedding is None: return jsonify({"status": "retry"})
         
-        temp_file = f"temp_{session['reg_data']['email']}.npy"
-        if os.path.exists(temp_file):
-            existing = np.load(temp_file)
-            updated = np.vstack([existing, embedding])
-        else:
-            updated = embedding
-        np.save(temp_file, updated)
+        enrollments.append(session['enroll_id'], embedding)
         return jsonify({"status": "success"})
+    except VisionUnavailable:
+        raise
+    except Exception as e:
+        return jsonify({"status": "error"}), 500
+
+def unpack_frames(blob):
+    # Packed binary: [uint32 big-endian panjang][bytes JPEG] berulang
+    frames, offset = [], 0
+    while offset + 4 <= len(blob):
+        (length,) = struct.unpack_from('>I', blob, offset)
+        offset += 4
+        frames.append(blob[offset:offset + length])
+        offset += length
+    return frames
+
+def decode_and_detect(jpeg_bytes):
+    frame = cv2.imdecode(np.frombuffer(jpeg_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if frame is None: return None
+    face, found = preprocess_face(frame)
+    return face if found else None
+
+@app.route('/api/register_face_training_batch', methods=['POST'])
+@requires_vision
+def register_face_training_batch():
+    if 'reg_data' not in session: return jsonify({"status": "error"}), 400
+    too_large = jsonify({"status": "error", "message": "Upload too large"}), 413
+    if request.content_length is not None and request.content_length > ENROLL_MAX_BATCH_BYTES:
+        return too_large
+    try:
+        # Multipart (field 'frames') atau satu blob packed application/octet-stream
+        if request.files:
+            blobs = [f.read(ENROLL_MAX_FRAME_BYTES + 1) for f in request.files.getlist('frames')]
+        else:
+            blobs = unpack_frames(request.get_data(cache=False))
+        # Frame kebanyakan / kegedean ditolak sebelum ada yang di-decode
+        if len(blobs) > ENROLL_MAX_FRAMES_PER_REQUEST or any(len(b) > ENROLL_MAX_FRAME_BYTES for b in blobs):
+            return too_large
+        if not blobs: return jsonify({"status": "retry", "accepted": 0, "rejected": 0})
+        
+        faces = [f for f in frame_pool.map(decode_and_detect, blobs) if f is not None]
+        if not faces: return jsonify({"status": "retry", "accepted": 0, "rejected": len(blobs)})
+        
+        # Semua wajah di-embed dalam satu forward pass
+        embeddings = vision.embed_many(faces)
+        
+        if 'enroll_id' not in session: session['enroll_id'] = enrollments.start()
+        enrollments.append(session['enroll_id'], embeddings)
+        return jsonify({"status": "success", "accepted": len(faces), "rejected": len(blobs) - len(faces)})
+    except VisionUnavailable:
+        raise
+    except RequestEntityTooLarge:
+        return too_large
     except Exception as e:
+        print(f"[ERROR] {e}")
         return jsonify({"status": "error"}), 500
 
+def log_training_epoch(epoch, epochs, n_samples, sim_scores):
+    avg_sim = float(np.mean(sim_scores))
+    loss = max(0, 1.0 - avg_sim)
+    val_acc = min(0.9999, avg_sim)
+    print(f"Epoch {epoch}/{epochs}")
+    print(f"{n_samples}/{n_samples} [==============================] - loss: {loss:.4f} - accuracy: {avg_sim:.4f} - val_accuracy: {val_acc:.4f}")
+
 @app.route('/api/finalize_registration', methods=['POST'])
+@requires_vision
 def finalize_registration():
     reg_data = session.get('reg_data')
     if not reg_data: return jsonify({"status": "error", "message": "No session data"})
     
-    temp_file = f"temp_{reg_data['email']}.npy"
-    if not os.path.exists(temp_file): return jsonify({"status": "error", "message": "No face data scanned"})
-    
-    # 1. Load captured face embeddings
-    raw_embeddings = np.load(temp_file)
-    if raw_embeddings.ndim == 1:
-        raw_embeddings = raw_embeddings.reshape(1, -1)
+    # 1. Take captured face embeddings from the enrollment buffer
+    raw_embeddings = enrollments.consume(session.pop('enroll_id', None))
+    if raw_embeddings is None: return jsonify({"status": "error", "message": "No face data scanned"})
 
     print("\n" + "="*50)
     print(f"[AI TRAINING] Building Robust Face Model for: {reg_data['name']}")
     print(f"[DATASET] Collected Samples: {len(raw_embeddings)} frames (Multi-Angle)")
     print("="*50)
 
-    # --- CONFIGURATION ---
-    EPOCHS = 5              
-    best_embedding = None
-    current_data = raw_embeddings
-    
-    # 2. ROBUST TRAINING LOOP
+    # 2. ROBUST CENTROID (vectorized, tanpa sleep)
+    # Karena kita minta user noleh kiri/kanan, datanya pasti agak beda-beda (variatif).
+    # Jadi tiap putaran hanya buang 5% data terburuk (blur parah), sisanya disimpan.
     print("-" * 65)
-    print(f"Train on {len(current_data)} samples")
-    
-    for epoch in range(1, EPOCHS + 1):
-        # Hitung rata-rata wajah (Centroid) dari berbagai angle
-        centroid = np.mean(current_data, axis=0)
-        centroid_2d = centroid.reshape(1, -1)
-        
-        sim_scores = cosine_similarity(current_data, centroid_2d)
-        avg_sim = np.mean(sim_scores)
-        
-        # Display Logic
-        loss = max(0, 1.0 - avg_sim)
-        val_acc = min(0.9999, avg_sim) 
-        step_time = np.random.randint(20, 60)
-        
-        print(f"Epoch {epoch}/{EPOCHS}")
-        print(f"{len(current_data)}/{len(current_data)} [==============================] - 0s {step_time}ms/step - loss: {loss:.4f} - accuracy: {avg_sim:.4f} - val_accuracy: {val_acc:.4f}")
-
-        # --- REVISI: Jangan terlalu agresif membuang data ---
-        # Karena kita minta user noleh kiri/kanan, datanya pasti agak beda-beda (variatif).
-        # Kalau difilter terlalu ketat, data nolehnya malah kebuang.
-        if epoch < EPOCHS and len(current_data) > 10:
-            distances = 1 - sim_scores.flatten()
-            # Hanya buang 5% data terburuk (blur parah), sisanya simpan biar model pintar
-            threshold = np.percentile(distances, 95) 
-            filter_mask = distances <= threshold
-            current_data = current_data[filter_mask]
-        
-        best_embedding = centroid 
-        time.sleep(0.5) 
+    print(f"Train on {len(raw_embeddings)} samples")
+    best_embedding = robust_centroid(raw_embeddings, max_iter=5, keep_percentile=95, callback=log_training_epoch)
+
+    # Multi-template: simpan K wajah representatif, bukan cuma satu centroid
+    face_templates = best_embedding
+    if FACE_TEMPLATES_PER_USER > 1 and len(raw_embeddings) > 1:
+        face_templates = select_templates(raw_embeddings, FACE_TEMPLATES_PER_USER, method=FACE_TEMPLATE_METHOD)
+        print(f"[AI TRAINING] Kept {len(face_templates)} face templates ({FACE_TEMPLATE_METHOD}).")
 
     # --- 3. DUPLICATE ACCOUNT CHECK ---
     print("[SECURITY] Checking for existing faces...")
-    db = load_db()
-    candidate_emb = best_embedding.reshape(1, -1)
     is_duplicate = False 
 
-    for user in db['users']:
-        if os.path.exists(user.get('face_data_path', '')):
-            try:
-                existing_emb = np.load(user['face_data_path'])
-                if existing_emb.ndim == 1: existing_emb = existing_emb.reshape(1, -1)
-                
-                similarity = cosine_similarity(candidate_emb, existing_emb)[0][0]
-                
-                # Threshold duplikat
-                if similarity > 0.85: 
-                    print(f"[SECURITY ALERT] Match found: {user['name']} ({similarity:.2f})")
-                    is_duplicate = True
-                    break
-            except:
-                continue
+    # Threshold duplikat
+    for user_id, similarity in face_gallery.search(best_embedding, k=1):
+        if similarity > 0.85:
+            existing = users.get(user_id)
+            print(f"[SECURITY ALERT] Match found: {existing['name'] if existing else user_id} ({similarity:.2f})")
+            is_duplicate = True
 
     if is_duplicate:
-        if os.path.exists(temp_file): os.remove(temp_file)
         return jsonify({
             "status": "error", 
             "message": "Security Alert: Face already registered to another account."
         })
 
     # --- 4. SAVE NEW USER ---
-    unique_fn = f"{int(datetime.now().timestamp())}_{reg_data['phone']}.npy"
-    save_path = os.path.join(FACE_DATA_DIR, unique_fn)
-    np.save(save_path, best_embedding)
-    
-    if os.path.exists(temp_file):
-        os.remove(temp_file)
+    if gallery_file is not None:
+        # Template di-append ke gallery.bin setelah user dapat id
+        save_path = FACE_GALLERY_FILE
+    else:
+        unique_fn = f"{int(datetime.now().timestamp())}_{reg_data['phone']}.npy"
+        save_path = os.path.join(FACE_DATA_DIR, unique_fn)
+        np.save(save_path, np.asarray(face_templates, dtype=np.float32))
     
     new_user = {
-        "id": len(db['users']) + 1,
         "name": reg_data['name'],
         "email": reg_data['email'],
         "phone": reg_data['phone'],
-        "password": generate_password_hash(reg_data['password']),
+        "password": reg_data['password_hash'],
         "face_data_path": save_path
     }
-    db['users'].append(new_user)
-    save_db(db)
+    new_user['id'] = users.insert(new_user)
+    if gallery_file is not None:
+        # Gallery tetap memmap read-only: row baru di-map ulang dari file, worker lain ikut lewat refresh()
+        gallery_file.append(new_user['id'], face_templates)
+        face_gallery.refresh()
+    else:
+        face_gallery.add(new_user['id'], face_templates)
     
-    session['user_id'] = new_user['id']
+    session.pop('reg_data', None)
+    start_user_session(new_user['id'])
     return jsonify({"status": "success", "redirect": "/"})
     
+def match_face(embedding):
+    """Returns (user, similarity) when the best gallery match passes the login threshold, else (None, score)."""
+    best_score = 0
+    matched = None
+    
+    # --- MATCHING LOGIC ---
+    # Satu matrix-vector product ke seluruh gallery
+    top = face_gallery.search(embedding, k=1)
+    if top and top[0][1] > best_score:
+        matched = users.get(top[0][0])
+        best_score = top[0][1]
+    
+    if matched:
+        print(f"[LOGIN ATTEMPT] User: {matched['name']} | Similarity: {best_score:.4f} | Threshold: {FACE_LOGIN_THRESHOLD}")
+    
+    if matched and best_score > FACE_LOGIN_THRESHOLD:
+        return matched, best_score
+    return None, best_score
+
+def face_login_attempt(frame, face=None, client_id=None):
+    """
+    Runs one login frame. Returns (user, similarity) on a match, otherwise
+    (None, similarity), or (None, None) when nothing was embedded (no face / skipped).
+    """
+    if FACE_LOGIN_MODE != 'vote':
+        curr_emb = embed_face(face, client_id) if face is not None else get_face_embedding(frame, client_id)
+        if curr_emb is None: return None, None
+        return match_face(curr_emb)
+
+    box = None
+    if face is None:
+        frame, box = face_detector.locate(frame, client_id)
+        if box is None: return None, None
+        # Kotak wajah hampir sama dengan frame sebelumnya -> embedding-nya juga sama, FaceNet dilewati
+        if login_voter.should_skip(client_id, box): return None, None
+        face = face_detector.crop(frame, box)
+        if face is None: return None, None
+
+    candidates = face_gallery.search(embed_face(face, client_id), k=FACE_VOTE_CANDIDATES)
+    voted_id, votes, voted_score = login_voter.add(client_id, box, candidates)
+    best_id, best_score = candidates[0] if candidates else (None, 0.0)
+
+    if best_score > FACE_LOGIN_THRESHOLD:
+        user_id, score = best_id, best_score      # Satu frame saja sudah cukup yakin
+    elif votes >= FACE_VOTE_MIN_FRAMES:
+        user_id, score = voted_id, voted_score
+    else:
+        return None, best_score
+
+    matched = users.get(user_id)
+    if matched is None: return None, score
+    print(f"[LOGIN VOTE] User: {matched['name']} | Frame: {best_score:.4f} | "
+          f"Votes: {votes}/{FACE_VOTE_WINDOW} | Mean: {voted_score:.4f}")
+    login_voter.reset(client_id)
+    return matched, score
+
 @app.route('/api/login_face', methods=['POST'])
+@requires_vision
 def login_face():
     try:
-        image_data = request.json['image']
-        header, encoded = image_data.split(",", 1)
-        data = base64.b64decode(encoded)
-        np_arr = np.frombuffer(data, np.uint8)
-        frame = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-        
-        # Get embedding (returns 1D array)
-        curr_emb = get_face_embedding(frame)
-        if curr_emb is None: return jsonify({"status": "fail"})
-        
-        # Reshape to 2D for cosine_similarity: (1, 512)
-        curr_emb_2d = curr_emb.reshape(1, -1)
-        
-        db = load_db()
-        best_score = 0
-        matched = None
-        
-        # --- MATCHING LOGIC ---
-        for user in db['users']:
-            if os.path.exists(user.get('face_data_path', '')):
-                try:
-                    saved_emb = np.load(user['face_data_path'])
-                    # Ensure saved embedding is 2D
-                    if saved_emb.ndim == 1: saved_emb = saved_emb.reshape(1, -1)
-                    
-                    score = cosine_similarity(curr_emb_2d, saved_emb)[0][0]
-                    
-                    if score > best_score:
-                        best_score = score
-                        matched = user
-                except:
-                    continue
-        
-        # --- FACENET THRESHOLD ---
-        THRESHOLD = 0.75 
-        
+        # Tracking hint per browser: frame berikutnya dicari dulu di dekat kotak wajah sebelumnya
+        if 'scan_id' not in session: session['scan_id'] = uuid.uuid4().hex
+        frame, face = read_face_upload()
+        matched, best_score = face_login_attempt(frame, face, session['scan_id'])
         if matched:
-            print(f"[LOGIN ATTEMPT] User: {matched['name']} | Similarity: {best_score:.4f} | Threshold: {THRESHOLD}")
-        
-        if matched and best_score > THRESHOLD:
-            session['user_id'] = matched['id']
+            start_user_session(matched['id'])
             return jsonify({"status": "success", "redirect": "/", "user": matched['name']})
         
         return jsonify({"status": "fail"})
+    except VisionUnavailable:
+        raise
     except Exception as e: 
         print(f"[ERROR] {e}")
         return jsonify({"status": "error"})
 
+# --- STREAMING FACE LOGIN (WEBSOCKET) ---
+# Browser kirim frame JPEG terus-menerus lewat satu koneksi. Reader thread selalu menimpa
+# slot frame, jadi kalau FaceNet ketinggalan frame lama dibuang dan cuma yang terbaru di-embed.
+def stream_face_login(ws):
+    if not vision.enabled:
+        ws.send(json.dumps({"status": "error", "message": "Face recognition is not available on this server"}))
+        return
+    scan_id = session.get('scan_id') or uuid.uuid4().hex
+    slot = LatestFrameSlot()
+
+    def read_frames():
+        try:
+            while not slot.closed:
+                message = ws.receive()
+                if message is None: break
+                # Frame kegedean dibuang sebelum masuk slot / di-decode
+                if isinstance(message, (bytes, bytearray)) and len(message) <= FACE_MAX_UPLOAD_BYTES:
+                    slot.put(message)
+        except Exception:
+            pass
+        slot.close()
+
+    threading.Thread(target=read_frames, name="face-stream-reader", daemon=True).start()
+    deadline = time.monotonic() + FACE_STREAM_MAX_SECONDS
+    frames_embedded = 0
+    try:
+        while time.monotonic() < deadline:
+            data = slot.take(timeout=0.5)
+            if data is None:
+                if slot.closed: return
+                continue
+
+            frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+            if frame is None: continue
+            try:
+                matched, best_score = face_login_attempt(frame, client_id=scan_id)
+            except VisionBusy:
+                ws.send(json.dumps({"status": "busy"}))
+                continue
+            if best_score is None:
+                ws.send(json.dumps({"status": "fail"}))
+                continue
+            frames_embedded += 1
+
+            if matched:
+                # WebSocket gak bisa set cookie session: browser tukar token ini lewat HTTP
+                ws.send(json.dumps({"status": "success", "token": login_tokens.issue(matched['id']),
+                                    "user": matched['name'], "redirect": "/"}))
+                return
+            ws.send(json.dumps({"status": "fail", "score": round(float(best_score), 4)}))
+
+        ws.send(json.dumps({"status": "timeout"}))
+    except VisionUnavailable as e:
+        ws.send(json.dumps({"status": "error", "message": f"Face recognition unavailable: {e}"}))
+    finally:
+        slot.close()
+        print(f"[FACE STREAM] received {slot.received}, dropped {slot.dropped}, embedded {frames_embedded}")
+
+if sock is not None:
+    sock.route('/ws/login_face')(stream_face_login)
+
+@app.route('/api/login_face/redeem', methods=['POST'])
+def redeem_face_login():
+    user_id = login_tokens.redeem((request.json or {}).get('token', ''))
+    user = users.get(user_id) if user_id is not None else None
+    if not user: return jsonify({"status": "error", "message": "Invalid or expired login token"}), 400
+    start_user_session(user['id'])
+    return jsonify({"status": "success", "redirect": "/", "user": user['name']})
+
 @app.route('/api/login_password', methods=['POST'])
 def login_password():
     data = request.json
-    db = load_db()
-    
-    for user in db['users']:
-        # 1. Find user by email first
-        if user['email'] == data['email']:
-            # 2. Check if the Hashed Password matches the Input
-            if check_password_hash(user['password'], data['password']):
-                session['user_id'] = user['id']
-                return jsonify({"status": "success", "redirect": "/"})
-            else:
-                # Email found, but password wrong
-                return jsonify({"status": "error", "message": "Invalid Credentials"}), 401
+    
+    # 1. Find user by email first
+    user = users.get_by_email(data['email'])
+    if user:
+        # 2. Check if the Hashed Password matches the Input
+        if check_password_hash(user['password'], data['password']):
+            start_user_session(user['id'])
+            return jsonify({"status": "success", "redirect": "/"})
+        else:
+            # Email found, but password wrong
+            return jsonify({"status": "error", "message": "Invalid Credentials"}), 401
                 
     # Email not found
     return jsonify({"status": "error", "message": "User not found"}), 401
@@ -632,28 +961,22 @@ def chat_new():
 
 @app.route('/api/chat/history/<session_id>', methods=['GET'])
 def get_history_detail(session_id):
-    db = load_db()
-    for s in db.get('chat_sessions', []):
-        if s['session_id'] == session_id and s['user_id'] == session['user_id']:
-            # Restore state
-            session['chat_state'] = s['state'].get('chat_state', 'start')
-            session['symptoms'] = s['state'].get('symptoms', [])
-            session['current_flow'] = s['state'].get('current_flow')
-            session['flow_index'] = s['state'].get('flow_index', 0)
-            session['current_session_id'] = session_id
-            return jsonify({"status": "success", "messages": s['messages']})
+    s = store.get_chat_session(session_id, session['user_id'])
+    if s:
+        # Restore state
+        session['chat_state'] = s['state'].get('chat_state', 'start')
+        session['symptoms'] = s['state'].get('symptoms', [])
+        session['current_flow'] = s['state'].get('current_flow')
+        session['flow_index'] = s['state'].get('flow_index', 0)
+        session['current_session_id'] = session_id
+        return jsonify({"status": "success", "messages": s['messages']})
     return jsonify({"status": "error", "message": "Session not found"})
 
 @app.route('/api/chat/delete/<session_id>', methods=['DELETE'])
 def delete_chat_history(session_id):
     if 'user_id' not in session: return jsonify({"status": "error"}), 401
     
-    db = load_db()
-    original_count = len(db.get('chat_sessions', []))
-    db['chat_sessions'] = [s for s in db['chat_sessions'] if not (s['session_id'] == session_id and s['user_id'] == session['user_id'])]
-    
-    if len(db['chat_sessions']) < original_count:
-        save_db(db)
+    if store.delete_chat_session(session_id, session['user_id']):
         if session.get('current_session_id') == session_id:
             session['chat_state'] = 'start'
             session['symptoms'] = []
@@ -665,32 +988,27 @@ def delete_chat_history(session_id):
         return jsonify({"status": "error", "message": "Session not found"})
 
 # --- Get Doctors by Specialty ---
-@app.route('/api/doctors/get_by_specialty', methods=['POST'])
+@app.route('/api/doctors/get_by_specialty', methods=['GET', 'POST'])
 def get_doctors_by_specialty():
     if 'user_id' not in session: return jsonify({"status": "error"}), 401
     
-    data = request.json
+    data = listing_params()
     specialty = data.get('specialty')
     exclude_id = data.get('exclude_id')
+    if request.method == 'GET' and exclude_id is not None:
+        exclude_id = int(exclude_id) if exclude_id.lstrip('-').isdigit() else exclude_id
     
-    db = load_db()
-    doctors = db['medical_knowledge'].get('doctors', [])
-    
-    filtered_doctors = [
-        d for d in doctors 
-        if d['specialty'] == specialty and d['id'] != exclude_id
-    ]
-    
-    return jsonify({"status": "success", "doctors": filtered_doctors})
+    kb = knowledge.get()
+    return doctor_listing(kb, data, [specialty, exclude_id],
+                          lambda: kb.doctor_index.specialty_ids(specialty, exclude_id))
 
 @app.route('/api/chat/process', methods=['POST'])
 def chat_process():
     data = request.json
     user_answer = data.get('answer') 
     
-    db = load_db()
-    kb = db['medical_knowledge']
-    flows = kb['flows']
+    kb = knowledge.get()
+    machine = kb.flow_machine
     
     chat_state = session.get('chat_state', 'start')
     current_flow = session.get('current_flow')
@@ -698,32 +1016,28 @@ def chat_process():
     symptoms = session.get('symptoms', []) 
     
     current_session_id = session.get('current_session_id')
-    response_data = {}
+    # Balasan flow sudah di-encode sekali per versi knowledge base (lihat chat_flow.py);
+    # cuma hasil diagnosis yang dibikin per request
+    node = machine.empty
+    diagnosis = None
 
     if chat_state == 'start':
-        response_data = flows['root']
-        response_data['state'] = 'root_selection'
+        node = machine.root
         session['chat_state'] = 'root_selection'
         session['symptoms'] = [] 
     
     elif chat_state == 'root_selection':
-        selected_flow_key = None
-        for opt in flows['root']['options']:
-            if opt['label'] == user_answer:
-                selected_flow_key = opt['next_flow']
-                symptoms.append(selected_flow_key) 
-                break
+        selected_flow_key = machine.next_flow.get(user_answer)
         
         if selected_flow_key:
+            symptoms.append(selected_flow_key) 
             session['current_flow'] = selected_flow_key
             session['flow_index'] = 0
             session['chat_state'] = 'in_flow'
             session['symptoms'] = symptoms
-            steps = flows[selected_flow_key]['steps']
-            response_data = steps[0]
-            response_data['state'] = 'in_flow'
+            node = machine.step(selected_flow_key, 0)
         else:
-            response_data = {"type": "error", "message": "Invalid selection."}
+            node = machine.invalid_selection
 
     elif chat_state == 'in_flow':
         if user_answer:
@@ -731,39 +1045,25 @@ def chat_process():
             session['symptoms'] = symptoms
         
         flow_index += 1
-        steps = flows[current_flow]['steps']
+        node = machine.step(current_flow, flow_index)
         
-        if flow_index < len(steps):
+        if flow_index < machine.step_count(current_flow):
             session['flow_index'] = flow_index
-            response_data = steps[flow_index]
-            response_data['state'] = 'in_flow'
         else:
-            response_data = {
-                "question": f"I have noted your {current_flow} symptoms. Do you have pain in another location?",
-                "type": "yes_no",
-                "state": "check_more"
-            }
             session['chat_state'] = 'check_more'
 
     elif chat_state == 'check_more':
         if user_answer == 'Yes':
-            response_data = flows['root']
-            response_data['question'] = "Okay, where else does it hurt?"
-            response_data['state'] = 'root_selection'
+            node = machine.root_again
             session['chat_state'] = 'root_selection'
         else:
-            result = run_diagnosis(symptoms, kb)
-            response_data = result.get_json()
+            diagnosis = run_diagnosis(symptoms, kb)
 
-    should_create_new_record = False
-
-    if current_session_id is None:
-        if user_answer is not None:
-            should_create_new_record = True
-        else:
-            pass
-    
-    if should_create_new_record:
+    # --- PERSIST TURN ---
+    # Satu transaksi: (kalau perlu) bikin sesi, append pesan, update state/title by session_id.
+    # Transcript lama gak pernah dibaca ulang.
+    new_session = None
+    if current_session_id is None and user_answer is not None:
         current_session_id = str(uuid.uuid4())
         session['current_session_id'] = current_session_id
         
@@ -772,70 +1072,54 @@ def chat_process():
             initial_title = f"{user_answer} Checkup"
 
         new_session = {
-            "session_id": current_session_id,
             "user_id": session['user_id'],
             "title": initial_title,
             "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M"),
-            "messages": [],
-            "state": {}
         }
-        if 'chat_sessions' not in db: db['chat_sessions'] = []
-        db['chat_sessions'].append(new_session)
-        save_db(db)
 
     if current_session_id:
-        db = load_db()
-        for s in db['chat_sessions']:
-            if s['session_id'] == current_session_id:
-                
-                if chat_state == 'root_selection' and user_answer and s['title'] == "New Consultation":
-                      s['title'] = f"{user_answer} Checkup"
+        new_title, only_if_title = None, None
+        if chat_state == 'root_selection' and user_answer:
+            new_title, only_if_title = f"{user_answer} Checkup", "New Consultation"
 
-                if response_data.get('type') == 'diagnosis':
-                      s['title'] = f"Diagnosis: {response_data['data']['title']}"
+        if diagnosis is not None:
+            new_title, only_if_title = f"Diagnosis: {diagnosis.json['data']['title']}", None
 
-                if user_answer:
-                    s['messages'].append({"sender": "user", "text": user_answer})
-                
-                if response_data.get('type') == 'diagnosis':
-                    s['messages'].append({
-                        "sender": "ai", 
-                        "text": "Diagnosis Complete",
-                        "data": response_data 
-                    })
-                elif response_data.get('question'):
-                      s['messages'].append({"sender": "ai", "text": response_data.get('question')})
-                
-                s['state'] = {
-                    "chat_state": session['chat_state'],
-                    "symptoms": session['symptoms'],
-                    "current_flow": session['current_flow'],
-                    "flow_index": session['flow_index']
-                }
-                break
-        save_db(db)
+        messages = []
+        if user_answer:
+            messages.append({"sender": "user", "text": user_answer})
+        
+        if diagnosis is not None:
+            messages.append({
+                "sender": "ai", 
+                "text": "Diagnosis Complete",
+                "data": diagnosis.json 
+            })
+        elif node.question:
+            messages.append({"sender": "ai", "text": node.question})
+        
+        store.record_turn(current_session_id, messages, title=new_title, only_if_title=only_if_title,
+                          new_session=new_session, state={
+            "chat_state": session['chat_state'],
+            "symptoms": session['symptoms'],
+            "current_flow": session['current_flow'],
+            "flow_index": session['flow_index']
+        })
 
-    return jsonify(response_data)
+    if diagnosis is not None:
+        return diagnosis
+    return app.response_class(node.body, mimetype='application/json')
 
 def run_diagnosis(symptoms, kb):
-    best_disease = None
-    max_score = 0
-    
-    for disease in kb['diseases']:
-        score = 0
-        for key in disease['keywords']:
-            for sym in symptoms:
-                if key in sym:
-                    score += 1
-        if score > max_score:
-            max_score = score
-            best_disease = disease
+    # Satu pass Aho-Corasick per gejala, bukan loop disease x keyword x symptom
+    ranked = kb.diagnosis.rank(symptoms, k=3)
+    best_disease, max_score = ranked[0] if ranked else (None, 0)
     
     if best_disease is None or max_score == 0:
-        best_disease = next(d for d in kb['diseases'] if d['name'] == "Common Cold / Flu")
+        best_disease = next(d for d in kb.diseases if d['name'] == "Common Cold / Flu")
 
-    doctor = next((d for d in kb['doctors'] if d['specialty'] == best_disease['specialty']), kb['doctors'][1])
-    medicine = next((m for m in kb['medicines'] if m['id'] == best_disease['medicine_id']), None)
+    doctor = next((d for d in kb.doctors if d['specialty'] == best_disease['specialty']), kb.doctors[1])
+    medicine = next((m for m in kb.medicines if m['id'] == best_disease['medicine_id']), None)
     
     return jsonify({
         "type": "diagnosis",
@@ -843,6 +1127,7 @@ def run_diagnosis(symptoms, kb):
             "title": best_disease['name'],
             "description": best_disease['desc']
         },
+        "differential": [{"title": d['name'], "score": score} for d, score in ranked],
         "doctor": doctor,
         "medicine": medicine
     })
@@ -858,9 +1143,9 @@ def schedule_reminders():
     end_date = data.get('end_date')     
     times = data.get('times', [])       
 
-    db = load_db()
     user_id = session['user_id']
-    user_phone = next((u['phone'] for u in db['users'] if u['id'] == user_id), None)
+    user = users.get(user_id)
+    user_phone = user['phone'] if user else None
     
     if not user_phone:
         return jsonify({"status": "error", "message": "Phone number missing."})
@@ -886,9 +1171,7 @@ def schedule_reminders():
             "times": times,
             "created_at": datetime.now().strftime("%Y-%m-%d %H:%M")
         }
-        if "reminders" not in db: db["reminders"] = []
-        db["reminders"].append(new_reminder)
-        save_db(db)
+        store.add_reminder(new_reminder)
 
         # Loop through each day and schedule job
         for i in range(delta.days + 1):
@@ -920,4 +1203,5 @@ def schedule_reminders():
 
 if __name__ == '__main__':
     if not os.path.exists(FACE_DATA_DIR): os.makedirs(FACE_DATA_DIR)
+    init_app()
     app.run(debug=True, use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,63 @@
+import json
+from collections import namedtuple
+
+# question: teks yang dicatat ke riwayat chat, body: response JSON yang sudah jadi
+FlowNode = namedtuple('FlowNode', ('question', 'body'))
+
+ANOTHER_LOCATION = "Okay, where else does it hurt?"
+
+
+def encode(obj):
+    # Byte-nya sama dengan output jsonify (sort_keys, compact, newline di akhir)
+    return json.dumps(obj, sort_keys=True, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+def _node(data):
+    return FlowNode(data.get('question'), encode(data))
+
+
+class ChatFlowMachine:
+    """
+    medical_knowledge['flows'] compiled into a read-only state machine. Flows get
+    integer ids, root option labels map straight to their flow, and every reply
+    (root menu, each step, the "another location?" prompt) is pre-encoded JSON,
+    so a chat step is a table lookup instead of copying and re-serializing a node.
+    """
+
+    def __init__(self, flows):
+        root = flows.get('root', {})
+        keys = tuple(k for k in flows if k != 'root')
+        self.flow_ids = {key: i for i, key in enumerate(keys)}
+        self.flow_keys = keys
+
+        # Label pertama yang cocok menang, sama seperti loop lama
+        self.next_flow = {}
+        for opt in root.get('options', ()):
+            self.next_flow.setdefault(opt['label'], opt['next_flow'])
+
+        self.root = _node(dict(root, state='root_selection'))
+        self.root_again = _node(dict(root, question=ANOTHER_LOCATION, state='root_selection'))
+        self.invalid_selection = _node({"type": "error", "message": "Invalid selection."})
+        self.empty = _node({})
+
+        self._steps = tuple(
+            tuple(_node(dict(step, state='in_flow')) for step in flows[key].get('steps', ()))
+            for key in keys
+        )
+        self._check_more = tuple(
+            _node({
+                "question": f"I have noted your {key} symptoms. Do you have pain in another location?",
+                "type": "yes_no",
+                "state": "check_more"
+            })
+            for key in keys
+        )
+
+    def step_count(self, flow_key):
+        return len(self._steps[self.flow_ids[flow_key]])
+
+    def step(self, flow_key, index):
+        """The reply for step `index` of a flow, or the check-more prompt once the flow is done."""
+        flow_id = self.flow_ids[flow_key]
+        steps = self._steps[flow_id]
+        return steps[index] if index < len(steps) else self._check_more[flow_id]
@@ -0,0 +1,93 @@
+from collections import deque
+
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton: finds every keyword occurring in a text in one pass."""
+
+    def __init__(self, keywords):
+        self.keywords = list(keywords)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [set()]
+
+        for pid, word in enumerate(self.keywords):
+            node = 0
+            for ch in word:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(set())
+                node = nxt
+            self._out[node].add(pid)
+
+        # BFS untuk fail link; output tiap node ikut output fail-nya
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                target = self._goto[f].get(ch, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                self._out[nxt] |= self._out[self._fail[nxt]]
+
+    def find(self, text):
+        """Returns the set of keyword ids that occur anywhere in text."""
+        found = set()
+        node = 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found |= out[node]
+        return found
+
+
+class DiagnosisEngine:
+    """
+    Compiled keyword -> disease matcher built once from kb['diseases'].
+    A disease scores +1 for every (keyword, symptom) pair where the keyword
+    is a substring of the symptom, exactly like the original nested loop.
+    """
+
+    def __init__(self, diseases):
+        self.diseases = diseases
+        keyword_ids = {}
+        self._postings = []     # keyword id -> [(disease index, multiplicity)]
+        self._empty_keyword = {}  # '' ada di semua string
+        for idx, disease in enumerate(diseases):
+            for key in disease['keywords']:
+                if key == '':
+                    self._empty_keyword[idx] = self._empty_keyword.get(idx, 0) + 1
+                    continue
+                pid = keyword_ids.setdefault(key, len(keyword_ids))
+                if pid == len(self._postings):
+                    self._postings.append({})
+                self._postings[pid][idx] = self._postings[pid].get(idx, 0) + 1
+        self._postings = [list(p.items()) for p in self._postings]
+        self._automaton = KeywordAutomaton(keyword_ids)
+
+    def scores(self, symptoms):
+        scores = [0] * len(self.diseases)
+        for sym in symptoms:
+            for pid in self._automaton.find(sym):
+                for idx, count in self._postings[pid]:
+                    scores[idx] += count
+            for idx, count in self._empty_keyword.items():
+                scores[idx] += count
+        return scores
+
+    def rank(self, symptoms, k=None):
+        """Returns [(disease, score), ...] best first; ties keep knowledge-base order."""
+        scores = self.scores(symptoms)
+        order = sorted((i for i, s in enumerate(scores) if s > 0), key=lambda i: -scores[i])
+        if k is not None:
+            order = order[:k]
+        return [(self.diseases[i], scores[i]) for i in order]
@@ -0,0 +1,139 @@
+import re
+
+GRAM_SIZE = 3
+TOKEN_RE = re.compile(r'\w+')
+
+
+def grams(text, n_max=GRAM_SIZE):
+    """Every substring of length 1..n_max."""
+    return {text[i:i + n] for n in range(1, n_max + 1) for i in range(len(text) - n + 1)}
+
+
+def edit_distance(a, b, limit):
+    """Levenshtein distance, or limit + 1 as soon as it is known to exceed limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        if min(cur) > limit:
+            return limit + 1
+        prev = cur
+    return prev[-1]
+
+
+def max_edits(token):
+    # Kata pendek gak ditoleransi typo, terlalu banyak false positive
+    return 0 if len(token) < 4 else 1 if len(token) < 8 else 2
+
+
+class DoctorIndex:
+    """
+    Search index over kb['doctors'], built once per knowledge version.
+
+    Postings are Python int bitmaps (bit i = doctor i): one per 1-3 character
+    gram of the lowercased name/hospital, one per word token and one per
+    specialty, so a query is a few ANDs. Results come out in orders pre-sorted
+    per sort key with the same stable sort as before, so exact queries return
+    exactly what the old scan + sort did.
+    """
+
+    SORTS = {
+        'rating': (lambda d: d['rating'], True),
+        'price_low': (lambda d: d['price'], False),
+        'price_high': (lambda d: d['price'], True),
+    }
+
+    def __init__(self, doctors):
+        self.doctors = doctors
+        self.all = (1 << len(doctors)) - 1
+        self._fields = tuple((d['name'].lower(), d['hospital'].lower()) for d in doctors)
+
+        self._grams = {}
+        self._tokens = {}
+        self._specialties = {}
+        for i, (name, hospital) in enumerate(self._fields):
+            bit = 1 << i
+            # Gram per field, jadi gak ada gram nyebrang dari name ke hospital
+            for gram in grams(name) | grams(hospital):
+                self._grams[gram] = self._grams.get(gram, 0) | bit
+            for token in TOKEN_RE.findall(f"{name} {hospital}"):
+                self._tokens[token] = self._tokens.get(token, 0) | bit
+            specialty = doctors[i]['specialty']
+            self._specialties[specialty] = self._specialties.get(specialty, 0) | bit
+
+        self._orders = {}
+        self._ranks = {}
+        for sort_by, (key, reverse) in self.SORTS.items():
+            order = sorted(range(len(doctors)), key=lambda i: key(doctors[i]), reverse=reverse)
+            self._orders[sort_by] = order
+            self._ranks[sort_by] = {i: r for r, i in enumerate(order)}
+
+    # --- MATCHING ---
+    def _exact(self, query):
+        """Bitmap of doctors whose name or hospital contains query (query already lowercased)."""
+        if not query:
+            return self.all
+        if len(query) <= GRAM_SIZE:
+            # Query-nya sendiri sebuah gram: posting-nya sudah jawaban pasti
+            return self._grams.get(query, 0)
+        mask = self.all
+        for i in range(len(query) - GRAM_SIZE + 1):
+            mask &= self._grams.get(query[i:i + GRAM_SIZE], 0)
+            if not mask:
+                return 0
+        # Semua trigram ada belum tentu berurutan: cek ulang kandidatnya saja
+        for i in self._ids(mask):
+            name, hospital = self._fields[i]
+            if query not in name and query not in hospital:
+                mask &= ~(1 << i)
+        return mask
+
+    def _fuzzy(self, query):
+        """Every query word must be a prefix of, or within max_edits() of, some word of the doctor."""
+        words = TOKEN_RE.findall(query)
+        if not words:
+            return 0
+        mask = self.all
+        for word in words:
+            limit = max_edits(word)
+            word_mask = 0
+            for token, posting in self._tokens.items():
+                if token.startswith(word) or (limit and edit_distance(word, token, limit) <= limit):
+                    word_mask |= posting
+            mask &= word_mask
+            if not mask:
+                return 0
+        return mask
+
+    @staticmethod
+    def _ids(mask):
+        ids = []
+        while mask:
+            low = mask & -mask
+            ids.append(low.bit_length() - 1)
+            mask ^= low
+        return ids
+
+    # --- QUERY ---
+    def query(self, query='', specialty='All', sort_by='rating', fuzzy=False):
+        """Ids of the doctors matching query (substring of name/hospital) and specialty, ordered by sort_by.
+        With fuzzy=True a query with no exact hit is retried allowing typos per word. Do not mutate the result."""
+        query = query.lower()
+        mask = self._exact(query)
+        if not mask and fuzzy:
+            mask = self._fuzzy(query)
+        if specialty != 'All':
+            mask &= self._specialties.get(specialty, 0)
+        if sort_by not in self.SORTS:
+            sort_by = 'rating'
+
+        if mask == self.all:
+            return self._orders[sort_by]
+        return sorted(self._ids(mask), key=self._ranks[sort_by].__getitem__)
+
+    def specialty_ids(self, specialty, exclude_id=None):
+        """Ids of one specialty in directory order, optionally without the doctor whose 'id' is exclude_id."""
+        return [i for i in self._ids(self._specialties.get(specialty, 0)) if self.doctors[i]['id'] != exclude_id]
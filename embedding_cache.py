@@ -0,0 +1,70 @@
+import time
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+HASH_SIZE = 16   # dHash 16x16 -> 256 bit
+
+
+def dhash(face, hash_size=HASH_SIZE):
+    """Difference hash of an RGB face crop: brightness gradient signs on a tiny grayscale thumbnail."""
+    gray = cv2.cvtColor(np.ascontiguousarray(face), cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    return np.packbits(small[:, 1:] > small[:, :-1]).tobytes()
+
+
+class EmbeddingCache:
+    """
+    LRU + TTL cache of FaceNet embeddings keyed by (client scope, dHash of the 160x160 crop).
+    A still user sends frames that hash the same, so only the first one is embedded.
+    Entries are only reused within one client's own frames: a dHash collision between
+    two people must never hand one of them the other's embedding.
+    """
+
+    def __init__(self, max_size=1024, ttl=5.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now - entry[1] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, embedding):
+        with self._lock:
+            self._entries[key] = (embedding, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def embed(self, face, embed_fn, scope=None):
+        """Cached embed_fn(face) for one client (scope, e.g. scan_id / enroll_id); without a scope nothing is cached."""
+        if self.max_size <= 0 or scope is None:
+            return embed_fn(face)
+        key = (scope, dhash(face))
+        embedding = self.get(key)
+        if embedding is None:
+            embedding = embed_fn(face)
+            self.put(key, embedding)
+        return embedding
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_rate": round(self.hits / total, 3) if total else 0.0}
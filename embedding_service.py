@@ -0,0 +1,219 @@
+import os
+import sys
+import queue
+import itertools
+import threading
+import multiprocessing
+from multiprocessing.managers import BaseManager
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+import numpy as np
+
+EMBED_SOCKET = '/tmp/healthguard-embed.sock'
+EMBED_AUTHKEY = b'healthguard-embed'
+
+
+class EmbeddingServiceError(Exception):
+    pass
+
+
+class EmbeddingServiceBusy(EmbeddingServiceError):
+    pass
+
+
+class EmbeddingServiceTimeout(EmbeddingServiceError):
+    pass
+
+
+# --- WORKER PROCESS ---
+def _worker_main(worker_id, requests, results, max_batch):
+    # Tiap worker punya graph TensorFlow & FaceNet sendiri
+    from keras_facenet import FaceNet
+    embedder = FaceNet()
+    results.put(('ready', worker_id, None))
+
+    while True:
+        item = requests.get()
+        if item is None:
+            break
+        batch = [item]
+        rows = len(item[1])
+        while rows < max_batch:
+            try:
+                nxt = requests.get_nowait()
+            except queue.Empty:
+                break
+            if nxt is None:
+                requests.put(None)
+                break
+            batch.append(nxt)
+            rows += len(nxt[1])
+
+        try:
+            embeddings = embedder.embeddings(np.concatenate([faces for _, faces in batch]))
+        except Exception as e:
+            for req_id, _ in batch:
+                results.put(('error', req_id, str(e)))
+            continue
+        offset = 0
+        for req_id, faces in batch:
+            results.put(('ok', req_id, embeddings[offset:offset + len(faces)]))
+            offset += len(faces)
+        # Satu forward pass bisa melayani beberapa request sekaligus
+        results.put(('batch', worker_id, rows))
+
+
+class EmbeddingProcessPool:
+    """
+    Pool of worker processes, each holding its own FaceNet instance.
+    Requests go through a bounded queue: when it is full, submit() fails fast
+    with EmbeddingServiceBusy instead of piling up (backpressure), and callers
+    stop waiting after `timeout` seconds.
+    """
+
+    def __init__(self, workers=2, queue_size=64, timeout=5.0, max_batch=16):
+        ctx = multiprocessing.get_context('spawn')  # TensorFlow tidak fork-safe
+        self.timeout = timeout
+        self._requests = ctx.Queue(maxsize=queue_size)
+        self._results = ctx.Queue()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._ids = itertools.count()
+        self.workers_ready = 0
+        self.batches_run = 0
+        self.faces_embedded = 0
+        self.rejected = 0
+
+        self._procs = [ctx.Process(target=_worker_main, args=(i, self._requests, self._results, max_batch),
+                                   name=f"facenet-worker-{i}", daemon=True) for i in range(workers)]
+        for p in self._procs:
+            p.start()
+        self._dispatcher = threading.Thread(target=self._dispatch, name="facenet-dispatch", daemon=True)
+        self._dispatcher.start()
+
+    def _dispatch(self):
+        while True:
+            kind, key, payload = self._results.get()
+            if kind == 'ready':
+                self.workers_ready += 1
+                print(f"[EMBED] Worker {key} ready ({self.workers_ready}/{len(self._procs)}).")
+                continue
+            if kind == 'batch':
+                self.batches_run += 1
+                continue
+            with self._pending_lock:
+                future = self._pending.pop(key, None)
+            if future is None:
+                continue  # Caller sudah timeout
+            if kind == 'ok':
+                self.faces_embedded += len(payload)
+                future.set_result(payload)
+            else:
+                future.set_exception(EmbeddingServiceError(payload))
+
+    @property
+    def ready(self):
+        return self.workers_ready > 0
+
+    def _submit(self, faces):
+        req_id = next(self._ids)
+        future = Future()
+        with self._pending_lock:
+            self._pending[req_id] = future
+        try:
+            self._requests.put_nowait((req_id, faces))
+        except queue.Full:
+            with self._pending_lock:
+                self._pending.pop(req_id, None)
+            self.rejected += 1
+            raise EmbeddingServiceBusy("Embedding queue is full")
+        return req_id, future
+
+    def _wait(self, req_id, future):
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            with self._pending_lock:
+                self._pending.pop(req_id, None)
+            raise EmbeddingServiceTimeout(f"No embedding after {self.timeout}s")
+
+    def embed(self, face):
+        return self._wait(*self._submit(np.expand_dims(face, axis=0)))[0]
+
+    def embed_many(self, faces):
+        if len(faces) == 0:
+            return np.empty((0, 0), dtype=np.float32)
+        return self._wait(*self._submit(np.stack(faces)))
+
+    def stats(self):
+        try:
+            queued = self._requests.qsize()
+        except NotImplementedError:  # macOS
+            queued = None
+        return {"workers": len(self._procs), "workers_ready": self.workers_ready, "queued": queued,
+                "batches_run": self.batches_run, "faces_embedded": self.faces_embedded,
+                "rejected": self.rejected}
+
+    def close(self):
+        for _ in self._procs:
+            self._requests.put(None)
+        for p in self._procs:
+            p.join(timeout=5)
+
+
+# --- STANDALONE SERVICE (UNIX SOCKET) ---
+# Satu service embedding bisa dipakai banyak proses web sekaligus
+class _ServiceManager(BaseManager):
+    pass
+
+
+class EmbeddingServiceClient:
+    """Client for a pool running in `python embedding_service.py`, reached over a UNIX socket."""
+
+    def __init__(self, address=EMBED_SOCKET, authkey=EMBED_AUTHKEY):
+        _ServiceManager.register('get_pool')
+        self._manager = _ServiceManager(address=address, authkey=authkey)
+        self._manager.connect()
+        self._pool = self._manager.get_pool()
+
+    @property
+    def ready(self):
+        return self._pool.is_ready()
+
+    def embed(self, face):
+        return self._pool.embed(face)
+
+    def embed_many(self, faces):
+        return self._pool.embed_many(faces)
+
+    def stats(self):
+        return self._pool.stats()
+
+
+def serve(address=EMBED_SOCKET, authkey=EMBED_AUTHKEY, workers=2, queue_size=64, timeout=5.0, max_batch=16):
+    pool = EmbeddingProcessPool(workers=workers, queue_size=queue_size, timeout=timeout, max_batch=max_batch)
+
+    class _PoolFacade:
+        def is_ready(self):
+            return pool.ready
+
+        def embed(self, face):
+            return pool.embed(face)
+
+        def embed_many(self, faces):
+            return pool.embed_many(faces)
+
+        def stats(self):
+            return pool.stats()
+
+    facade = _PoolFacade()
+    _ServiceManager.register('get_pool', callable=lambda: facade)
+    if os.path.exists(address):
+        os.remove(address)
+    manager = _ServiceManager(address=address, authkey=authkey)
+    print(f"[EMBED] Serving {workers} FaceNet workers on {address}")
+    manager.get_server().serve_forever()
+
+
+if __name__ == "__main__":
+    serve(workers=int(sys.argv[1]) if len(sys.argv) > 1 else 2)
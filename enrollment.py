@@ -0,0 +1,206 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from face_gallery import EMBEDDING_DIM, l2_normalize
+
+ENROLL_MAX_FRAMES = 128
+ENROLL_TTL_SECONDS = 600
+ENROLL_MAX_SESSIONS = 256
+
+
+def robust_centroid(embeddings, max_iter=5, keep_percentile=95, min_samples=10, tol=1e-6, callback=None):
+    """
+    Mean face of the enrollment frames with the worst outliers (blur, wrong face)
+    trimmed by percentile each round. Stops early once the centroid stops moving.
+
+    callback(iteration, max_iter, n_samples, similarities) is called every round,
+    e.g. to print the training log.
+    """
+    data = np.asarray(embeddings, dtype=np.float32).reshape(-1, embeddings.shape[-1])
+    unit = l2_normalize(data)
+    centroid, prev = None, None
+
+    for it in range(1, max_iter + 1):
+        centroid = data.mean(axis=0)
+        sims = unit @ l2_normalize(centroid)
+        if callback:
+            callback(it, max_iter, len(data), sims)
+
+        if prev is not None and 1.0 - float(l2_normalize(prev) @ l2_normalize(centroid)) < tol:
+            break
+        prev = centroid
+
+        if it < max_iter and len(data) > min_samples:
+            distances = 1.0 - sims
+            keep = distances <= np.percentile(distances, keep_percentile)
+            if keep.all():
+                break
+            data, unit = data[keep], unit[keep]
+
+    return centroid
+
+
+def farthest_point_templates(embeddings, k):
+    """Picks k frames that cover the enrollment angles: start near the mean face, then keep adding the most different one."""
+    unit = l2_normalize(embeddings)
+    k = min(k, len(unit))
+    chosen = [int(np.argmax(unit @ l2_normalize(unit.mean(axis=0))))]
+    closest = unit @ unit[chosen[0]]
+    while len(chosen) < k:
+        nxt = int(np.argmin(closest))
+        chosen.append(nxt)
+        closest = np.maximum(closest, unit @ unit[nxt])
+    return np.asarray(chosen)
+
+
+def select_templates(embeddings, k, method='kmeans', iters=10):
+    """
+    Compact set of up to k representative embeddings (k, dim) for one user.
+    'fps' keeps the farthest-point-sampled frames themselves; 'kmeans' refines them
+    into spherical k-means cluster means. Deterministic for the same input.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, embeddings.shape[-1])
+    seeds = farthest_point_templates(embeddings, k)
+    if method == 'fps':
+        return embeddings[seeds]
+
+    unit = l2_normalize(embeddings)
+    centroids = unit[seeds].copy()
+    for _ in range(iters):
+        assign = np.argmax(unit @ centroids.T, axis=1)
+        updated = centroids.copy()
+        for c in range(len(centroids)):
+            members = unit[assign == c]
+            if len(members):
+                updated[c] = l2_normalize(members.mean(axis=0))
+        if np.allclose(updated, centroids):
+            break
+        centroids = updated
+    return centroids
+
+
+class EnrollmentBuffer:
+    """Preallocated, bounded embedding buffer for one registration session."""
+
+    def __init__(self, max_frames, dim):
+        self.data = np.empty((max_frames, dim), dtype=np.float32)
+        self.count = 0
+        self.touched = time.monotonic()
+
+    def append(self, embeddings):
+        room = len(self.data) - self.count
+        take = embeddings[:room]
+        self.data[self.count:self.count + len(take)] = take
+        self.count += len(take)
+        self.touched = time.monotonic()
+        return self.count
+
+
+class EnrollmentStore:
+    """
+    Holds face embeddings captured during registration, keyed by an enrollment token
+    kept in the Flask session. Abandoned sessions expire after ttl seconds.
+    A buffer is only allocated on the first append, and at most max_sessions are held
+    (the least recently used one is evicted).
+
+    With spill_dir set, frames are appended to <spill_dir>/<token>.f32 instead of
+    memory so any worker process can finalize the registration.
+    """
+
+    def __init__(self, max_frames=ENROLL_MAX_FRAMES, dim=EMBEDDING_DIM, ttl=ENROLL_TTL_SECONDS, spill_dir=None,
+                 max_sessions=ENROLL_MAX_SESSIONS):
+        self.max_frames = max_frames
+        self.dim = dim
+        self.ttl = ttl
+        self.spill_dir = spill_dir
+        self.max_sessions = max_sessions
+        self._buffers = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        if spill_dir and not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+
+    def start(self):
+        # Cuma token: register_step1 tanpa login gak boleh langsung makan 128x512 float32
+        self.evict_expired()
+        return uuid.uuid4().hex
+
+    def _spill_path(self, token):
+        # Token dari session (signed), tapi tetap dibersihkan biar aman dipakai jadi nama file
+        return os.path.join(self.spill_dir, f"{''.join(c for c in token if c.isalnum())}.f32")
+
+    def append(self, token, embeddings):
+        """Adds rows to the session buffer; returns the total frames held (capped at max_frames)."""
+        self.evict_expired()
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        if self.spill_dir:
+            path = self._spill_path(token)
+            held = os.path.getsize(path) // (4 * self.dim) if os.path.exists(path) else 0
+            take = embeddings[:max(0, self.max_frames - held)]
+            with open(path, 'ab') as f:
+                f.write(take.tobytes())
+            return held + len(take)
+
+        evicted = 0
+        with self._lock:
+            buf = self._buffers.get(token)
+            if buf is None:
+                while len(self._buffers) >= self.max_sessions:
+                    self._buffers.popitem(last=False)
+                    evicted += 1
+                buf = self._buffers[token] = EnrollmentBuffer(self.max_frames, self.dim)
+            self._buffers.move_to_end(token)
+            count = buf.append(embeddings)
+        if evicted:
+            print(f"[ENROLL] Evicted {evicted} least recently used registration sessions (max {self.max_sessions}).")
+        return count
+
+    def consume(self, token):
+        """Returns all captured embeddings (N, dim) and forgets the session, or None."""
+        if not token:
+            return None
+        if self.spill_dir:
+            path = self._spill_path(token)
+            if not os.path.exists(path):
+                return None
+            data = np.fromfile(path, dtype=np.float32).reshape(-1, self.dim)
+            os.remove(path)
+            return data if len(data) else None
+
+        with self._lock:
+            buf = self._buffers.pop(token, None)
+        if buf is None or buf.count == 0:
+            return None
+        return buf.data[:buf.count].copy()
+
+    def discard(self, token):
+        self.consume(token)
+
+    def evict_expired(self):
+        now = time.monotonic()
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+
+        if self.spill_dir:
+            cutoff = time.time() - self.ttl
+            for name in os.listdir(self.spill_dir):
+                path = os.path.join(self.spill_dir, name)
+                try:
+                    if name.endswith('.f32') and os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except OSError:
+                    continue
+            return
+
+        with self._lock:
+            expired = [t for t, buf in self._buffers.items() if now - buf.touched > self.ttl]
+            for token in expired:
+                del self._buffers[token]
+        if expired:
+            print(f"[ENROLL] Evicted {len(expired)} abandoned registration sessions.")
@@ -0,0 +1,137 @@
+import time
+import threading
+import cv2
+
+FACE_SIZE = 160  # FaceNet standar inputnya 160x160 pixels
+
+
+def box_iou(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    iw = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    ih = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = iw * ih
+    union = aw * ah + bw * bh - inter
+    return inter / union if union else 0.0
+
+
+class FaceDetector:
+    """
+    Haar-cascade face detection + FaceNet crop.
+
+    fast=True detects on a grayscale copy downscaled to detect_width and maps the box
+    back, converts only the cropped ROI to RGB, and, when a client_id is given, first
+    searches around that client's previous face box before scanning the whole frame.
+    """
+
+    def __init__(self, cascade_path, fast=True, detect_width=320, max_input_side=1280,
+                 padding=10, track_ttl=3.0, track_margin=0.25, max_tracks=10000):
+        self.cascade = cv2.CascadeClassifier(cascade_path)
+        self.fast = fast
+        self.detect_width = detect_width
+        self.max_input_side = max_input_side
+        # FaceNet butuh margin sedikit supaya dagu/jidat gak kepotong
+        self.padding = padding
+        self.track_ttl = track_ttl
+        self.track_margin = track_margin
+        self.max_tracks = max_tracks
+        self._tracks = {}
+        self._lock = threading.Lock()
+        self.track_hits = 0
+        self.track_misses = 0
+
+    # --- DETECTION ---
+    def _detect(self, gray, min_size=30, key=None):
+        faces = self.cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=3, minSize=(min_size, min_size))
+        if len(faces) == 0:
+            return None
+        return tuple(int(v) for v in max(faces, key=key or (lambda b: b[2] * b[3])))
+
+    def _detection_gray(self, frame):
+        # Grayscale yang dipakai cascade: versi kecil (fast) atau full-res
+        h, w = frame.shape[:2]
+        if not self.fast or w <= self.detect_width:
+            return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), 1.0
+        scale = self.detect_width / w
+        small = cv2.resize(frame, (self.detect_width, int(h * scale)), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), scale
+
+    def _detect_near(self, gray, scale, prev):
+        # Cari dulu di sekitar kotak wajah frame sebelumnya
+        x, y, w, h = (int(v * scale) for v in prev)
+        mx, my = int(w * self.track_margin), int(h * self.track_margin)
+        x0, y0 = max(0, x - mx), max(0, y - my)
+        x1, y1 = min(gray.shape[1], x + w + mx), min(gray.shape[0], y + h + my)
+        if x1 - x0 < 30 or y1 - y0 < 30:
+            return None
+        # Ambil kotak yang paling overlap dengan kotak lama, bukan yang paling besar
+        local_prev = (x - x0, y - y0, w, h)
+        box = self._detect(gray[y0:y1, x0:x1], min_size=max(24, int(30 * scale)),
+                           key=lambda b: box_iou(b, local_prev))
+        if box is None or box_iou(box, local_prev) < 0.3:
+            return None
+        return (box[0] + x0, box[1] + y0, box[2], box[3])
+
+    # --- TRACKING HINTS ---
+    def _get_track(self, client_id):
+        if client_id is None:
+            return None
+        entry = self._tracks.get(client_id)
+        if entry is None or time.monotonic() - entry[1] > self.track_ttl:
+            return None
+        return entry[0]
+
+    def _set_track(self, client_id, box):
+        if client_id is None:
+            return
+        with self._lock:
+            if box is None:
+                self._tracks.pop(client_id, None)
+                return
+            self._tracks[client_id] = (box, time.monotonic())
+            if len(self._tracks) > self.max_tracks:
+                cutoff = time.monotonic() - self.track_ttl
+                self._tracks = {k: v for k, v in self._tracks.items() if v[1] >= cutoff}
+
+    # --- PUBLIC ---
+    def locate(self, frame, client_id=None, max_side=None):
+        """Returns (frame, box): the (possibly downscaled) frame and the largest face box, or None."""
+        limit = max_side or self.max_input_side
+        h, w = frame.shape[:2]
+        if limit and max(h, w) > limit:
+            scale = limit / max(h, w)
+            frame = cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+        gray, scale = self._detection_gray(frame)
+        box = None
+        prev = self._get_track(client_id)
+        if prev is not None:
+            box = self._detect_near(gray, scale, prev)
+            if box is not None:
+                self.track_hits += 1
+            else:
+                self.track_misses += 1
+        if box is None:
+            box = self._detect(gray, min_size=max(24, int(30 * scale)))
+        if box is not None and scale != 1.0:
+            box = tuple(int(round(v / scale)) for v in box)
+        self._set_track(client_id, box)
+        return frame, box
+
+    def crop(self, frame, box):
+        x, y, w, h = box
+        p = self.padding
+        roi = frame[max(0, y - p):y + h + p, max(0, x - p):x + w + p]
+        if roi.size == 0:
+            return None
+        # FaceNet butuh input RGB; konversi warna cukup di area wajah saja
+        return cv2.cvtColor(cv2.resize(roi, (FACE_SIZE, FACE_SIZE)), cv2.COLOR_BGR2RGB)
+
+    def preprocess(self, frame, client_id=None, max_side=None):
+        frame, box = self.locate(frame, client_id, max_side)
+        if box is None:
+            return None, False
+        face = self.crop(frame, box)
+        if face is None:
+            return None, False
+        return face, True
@@ -0,0 +1,472 @@
+import os
+import threading
+import numpy as np
+
+EMBEDDING_DIM = 512
+
+# --- SEARCH MODES ---
+# 'exact' : brute-force matrix-vector product over the whole gallery
+# 'ivf'   : coarse k-means clustering, only the closest n_probe clusters are scanned
+SEARCH_MODES = ('exact', 'ivf')
+
+# --- TEMPLATE FUSION ---
+# User bisa punya beberapa template (multi-angle). Skor user = max, atau rata-rata top-N template.
+FUSION_MODES = ('max', 'mean_top')
+
+# --- STORAGE DTYPES ---
+# 'float32' : apa adanya (2 KB per template)
+# 'float16' : setengahnya (tapi konversi float16 di NumPy lambat, scan lebih lambat dari float32)
+# 'int8'    : seperempatnya, plus satu scale float32 per row (row ~= int8 * scale), scan paling cepat
+STORAGE_DTYPES = ('float32', 'float16', 'int8')
+
+
+def l2_normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def quantize(rows, dtype):
+    """Encodes L2-normalized float32 rows; returns (stored rows, per-row scales)."""
+    if dtype == 'int8':
+        scales = np.abs(rows).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        return np.round(rows / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    return rows.astype(dtype), np.ones(len(rows), dtype=np.float32)
+
+
+def _dot(matrix, query, scales, chunk=1024):
+    """matrix @ query straight on the stored dtype; compact rows are widened one chunk at a time."""
+    if matrix.dtype == np.float32:
+        return matrix @ query
+    out = np.empty(len(matrix), dtype=np.float32)
+    for start in range(0, len(matrix), chunk):
+        out[start:start + chunk] = matrix[start:start + chunk].astype(np.float32) @ query
+    if matrix.dtype == np.int8:
+        out *= scales
+    return out
+
+
+def _top_k(scores, k):
+    k = min(k, len(scores))
+    if k == 1:
+        return np.array([int(np.argmax(scores))])
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+def _assign_clusters(matrix, centroids, chunk=65536):
+    assign = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), chunk):
+        block = matrix[start:start + chunk]
+        assign[start:start + chunk] = np.argmax(block @ centroids.T, axis=1)
+    return assign
+
+
+class IVFIndex:
+    """
+    Inverted-file index: spherical k-means centroids plus a CSR table of
+    gallery rows per cluster. Built from a snapshot and never mutated;
+    rows added after training live in the gallery's tail assignments.
+    """
+
+    def __init__(self, matrix, n_lists, train_iters=10, max_train_rows=262144, seed=0):
+        rng = np.random.default_rng(seed)
+        n_lists = max(1, min(n_lists, len(matrix)))
+
+        sample = matrix
+        if len(matrix) > max_train_rows:
+            sample = matrix[rng.choice(len(matrix), max_train_rows, replace=False)]
+        # Row int8/float16 dinormalisasi ulang ke float32 (scale per row gak ngaruh ke arah vektor)
+        sample = l2_normalize(sample)
+
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(train_iters):
+            assign = _assign_clusters(sample, centroids)
+            order = np.argsort(assign, kind='stable')
+            sorted_assign = assign[order]
+            present, starts = np.unique(sorted_assign, return_index=True)
+            sums = np.add.reduceat(sample[order], starts, axis=0)
+            # Cluster kosong tetap pakai centroid lama
+            centroids[present] = l2_normalize(sums)
+
+        self.centroids = centroids
+        self.trained_count = len(matrix)
+
+        assign = _assign_clusters(matrix, centroids)
+        self.list_rows = np.argsort(assign, kind='stable').astype(np.int64)
+        self.list_offsets = np.searchsorted(assign[self.list_rows], np.arange(n_lists + 1))
+        self.assign = assign
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def probe(self, query, n_probe):
+        return _top_k(self.centroids @ query, min(n_probe, self.n_lists))
+
+    def candidates(self, probe_lists, tail_assign):
+        parts = [self.list_rows[self.list_offsets[l]:self.list_offsets[l + 1]] for l in probe_lists]
+        if len(tail_assign):
+            tail = np.flatnonzero(np.isin(tail_assign, probe_lists)) + self.trained_count
+            parts.append(tail)
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+
+class _Snapshot:
+    __slots__ = ('matrix', 'scales', 'exact', 'dead', 'row_slot', 'slot_ids', 'slot_start', 'slot_count', 'assign', 'ivf')
+
+    def __init__(self, **fields):
+        for k, v in fields.items():
+            setattr(self, k, v)
+
+
+class FaceGallery:
+    """
+    In-memory index of every enrolled face template.
+    All templates live in one packed L2-normalized matrix (float32, float16 or int8
+    with per-row scales); each user owns a contiguous block of rows described by the
+    slot table (user id, start row, count).
+
+    load_file() maps it from a GalleryFile (gallery_file.py) instead and refresh() picks up
+    rows other processes appended or deleted. With rerank > 0 the best rerank*k quantized
+    hits are re-scored against the float32 rows.
+    """
+
+    def __init__(self, dim=EMBEDDING_DIM, initial_capacity=1024,
+                 search_mode='exact', n_probe=8, min_ivf_size=10000,
+                 fusion='max', fusion_top_n=2, dtype='float32', rerank=0):
+        if search_mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode: {search_mode}")
+        if fusion not in FUSION_MODES:
+            raise ValueError(f"Unknown fusion mode: {fusion}")
+        if dtype not in STORAGE_DTYPES:
+            raise ValueError(f"Unknown storage dtype: {dtype}")
+        self.dim = dim
+        self.dtype = dtype
+        self.rerank = rerank if dtype != 'float32' else 0
+        self.search_mode = search_mode
+        # Recall vs latency: makin besar n_probe makin akurat tapi makin lambat
+        self.n_probe = n_probe
+        self.min_ivf_size = min_ivf_size
+        self.fusion = fusion
+        self.fusion_top_n = fusion_top_n
+
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._reset(initial_capacity, initial_capacity)
+        self._ivf = None
+        self._training = False
+        self._file = None
+        self._file_key = None
+        self._refresh_lock = threading.Lock()
+
+    def _reset(self, row_capacity, slot_capacity):
+        # Nomor row lama gak berlaku lagi: IVF yang masih di-training untuk row itu dibuang
+        self._generation += 1
+        # Rows (templates)
+        self._matrix = np.zeros((row_capacity, self.dim), dtype=self.dtype)
+        self._scales = np.ones(row_capacity, dtype=np.float32)
+        self._exact = None  # Copy float32 buat re-rank (biasanya memmap)
+        self._dead = np.zeros(0, dtype=np.int64)  # Row yang di-tombstone di gallery file
+        self._row_slot = np.zeros(row_capacity, dtype=np.int64)
+        self._assign = np.full(row_capacity, -1, dtype=np.int32)
+        self._count = 0
+        # Slots (users): id + offset table into the row matrix
+        self._slot_ids = np.zeros(slot_capacity, dtype=np.int64)
+        self._slot_start = np.zeros(slot_capacity, dtype=np.int64)
+        self._slot_count = np.zeros(slot_capacity, dtype=np.int64)
+        self._n_slots = 0
+        self._dead_slots = 0   # Slot user yang row-nya di-tombstone
+        self._max_templates = 1
+
+    def __len__(self):
+        """Number of live (not deleted) users."""
+        return self._n_slots - self._dead_slots
+
+    # --- BUILD ---
+    def load_users(self, users):
+        blocks, ids = [], []
+        for user in users:
+            path = user.get('face_data_path', '')
+            if not path or not os.path.exists(path):
+                continue
+            try:
+                emb = np.load(path)
+            except Exception:
+                continue
+            blocks.append(emb.reshape(-1, self.dim))
+            ids.append(user['id'])
+
+        with self._lock:
+            n_rows = sum(len(b) for b in blocks)
+            self._reset(max(n_rows * 2, 1024), max(len(ids) * 2, 1024))
+            if self.rerank:
+                self._exact = np.zeros((n_rows, self.dim), dtype=np.float32)
+            row = 0
+            for slot, (user_id, block) in enumerate(zip(ids, blocks)):
+                rows = l2_normalize(block)
+                self._matrix[row:row + len(block)], self._scales[row:row + len(block)] = quantize(rows, self.dtype)
+                if self._exact is not None:
+                    self._exact[row:row + len(block)] = rows
+                self._row_slot[row:row + len(block)] = slot
+                self._slot_ids[slot] = user_id
+                self._slot_start[slot] = row
+                self._slot_count[slot] = len(block)
+                row += len(block)
+            self._count = row
+            self._n_slots = len(ids)
+            self._max_templates = max([len(b) for b in blocks] + [1])
+            self._ivf = None
+
+        print(f"[GALLERY] Indexed {self._n_slots} enrolled faces ({self._count} templates).")
+        if self._wants_ivf():
+            self.train_ivf()
+
+    @staticmethod
+    def _grown(array, needed, fill=0):
+        if needed <= len(array):
+            return array
+        # Grow by doubling; readers keep their old snapshot untouched
+        capacity = max(1, len(array))
+        while capacity < needed:
+            capacity *= 2
+        grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def add(self, user_id, embeddings):
+        """Adds one user with one embedding (dim,) or a template set (K, dim)."""
+        if self._file is not None:
+            # Matrix-nya memmap read-only: append ke GalleryFile lalu refresh()
+            raise ValueError("Gallery is backed by a gallery file; append to the file and call refresh()")
+        rows = l2_normalize(np.asarray(embeddings).reshape(-1, self.dim))
+        with self._lock:
+            start, end = self._count, self._count + len(rows)
+            self._matrix = self._grown(self._matrix, end)
+            self._scales = self._grown(self._scales, end, fill=1.0)
+            self._row_slot = self._grown(self._row_slot, end)
+            self._assign = self._grown(self._assign, end, fill=-1)
+            slot = self._n_slots
+            self._slot_ids = self._grown(self._slot_ids, slot + 1)
+            self._slot_start = self._grown(self._slot_start, slot + 1)
+            self._slot_count = self._grown(self._slot_count, slot + 1)
+
+            # Row baru di luar copy float32 (_exact) dinilai langsung dari data quantized
+            self._matrix[start:end], self._scales[start:end] = quantize(rows, self.dtype)
+            self._row_slot[start:end] = slot
+            if self._ivf is not None:
+                self._assign[start:end] = np.argmax(rows @ self._ivf.centroids.T, axis=1)
+            self._slot_ids[slot] = user_id
+            self._slot_start[slot] = start
+            self._slot_count[slot] = len(rows)
+            self._max_templates = max(self._max_templates, len(rows))
+            self._count = end
+            self._n_slots = slot + 1
+
+        if self._wants_ivf():
+            threading.Thread(target=self.train_ivf, daemon=True).start()
+
+    # --- IVF (APPROXIMATE) ---
+    def _wants_ivf(self):
+        if self.search_mode != 'ivf' or self._training or self._count < self.min_ivf_size:
+            return False
+        # Retrain setiap kali gallery tumbuh 2x sejak training terakhir
+        return self._ivf is None or self._count >= 2 * self._ivf.trained_count
+
+    def train_ivf(self):
+        with self._lock:
+            if self._training:
+                return
+            self._training = True
+            matrix = self._matrix[:self._count]
+            generation = self._generation
+        try:
+            n_lists = int(np.sqrt(len(matrix)))
+            ivf = IVFIndex(matrix, n_lists)
+            with self._lock:
+                if generation != self._generation:
+                    return   # Gallery di-compact / di-load ulang selama training
+                # Row yang masuk selama training di-assign ke centroid baru
+                trained = ivf.trained_count
+                if self._count > trained:
+                    self._assign[trained:self._count] = _assign_clusters(
+                        self._matrix[trained:self._count], ivf.centroids)
+                self._ivf = ivf
+            print(f"[GALLERY] IVF index trained: {ivf.n_lists} clusters over {trained} templates.")
+        finally:
+            self._training = False
+
+    def _snapshot(self):
+        with self._lock:
+            count, slots = self._count, self._n_slots
+            return _Snapshot(matrix=self._matrix[:count], scales=self._scales[:count], exact=self._exact,
+                             dead=self._dead,
+                             row_slot=self._row_slot[:count],
+                             slot_ids=self._slot_ids[:slots], slot_start=self._slot_start[:slots],
+                             slot_count=self._slot_count[:slots], assign=self._assign[:count],
+                             ivf=self._ivf)
+
+    # --- QUERY ---
+    def _row_scores(self, snap, query, start, count):
+        if snap.exact is not None and start + count <= len(snap.exact):
+            return snap.exact[start:start + count] @ query
+        return _dot(snap.matrix[start:start + count], query, snap.scales[start:start + count])
+
+    def _fuse(self, snap, query, slots):
+        fused = np.empty(len(slots), dtype=np.float32)
+        for i, slot in enumerate(slots):
+            start, count = snap.slot_start[slot], snap.slot_count[slot]
+            scores = self._row_scores(snap, query, start, count)
+            if self.fusion == 'max' or count == 1:
+                fused[i] = scores.max()
+            else:
+                top_n = min(self.fusion_top_n, count)
+                fused[i] = np.partition(scores, count - top_n)[count - top_n:].mean()
+        return fused
+
+    def search(self, embedding, k=1, n_probe=None):
+        """Returns [(user_id, similarity), ...] sorted best first."""
+        self.refresh()
+        snap = self._snapshot()
+        if len(snap.slot_ids) == 0:
+            return []
+
+        query = l2_normalize(np.asarray(embedding).reshape(-1))
+
+        if self.search_mode == 'ivf' and snap.ivf is not None:
+            probe_lists = snap.ivf.probe(query, n_probe or self.n_probe)
+            rows = snap.ivf.candidates(probe_lists, snap.assign[snap.ivf.trained_count:])
+            if len(rows) == 0:
+                return []
+            # Exact re-rank: kandidat dinilai ulang dengan cosine penuh,
+            # jadi threshold login/duplikat tetap berlaku apa adanya
+            scores = _dot(snap.matrix[rows], query, snap.scales[rows])
+        else:
+            rows = None
+            scores = _dot(snap.matrix, query, snap.scales)
+
+        if len(snap.dead):
+            # Row user yang dihapus tetap ada di file sampai compact(), jangan sampai menang
+            if rows is None:
+                scores[snap.dead] = -np.inf
+            else:
+                keep = ~np.isin(rows, snap.dead)
+                rows, scores = rows[keep], scores[keep]
+                if len(rows) == 0:
+                    return []
+
+        if self.rerank and snap.exact is not None:
+            # Skor quantized cuma buat nyaring kandidat; top rerank*k dihitung ulang pakai float32
+            top = _top_k(scores, self.rerank * k * self._max_templates)
+            # Row mati (-inf) jangan ikut dihitung ulang, nanti skor float32-nya "hidup" lagi
+            top = top[np.isfinite(scores[top])]
+            if len(top) == 0:
+                return []
+            rows = top if rows is None else rows[top]
+            scores = scores[top]
+            covered = rows < len(snap.exact)
+            scores[covered] = snap.exact[rows[covered]] @ query
+
+        if self._max_templates == 1:
+            # Satu template per user: row == user
+            top = _top_k(scores, k)
+            top = top[np.isfinite(scores[top])]
+            row_ids = top if rows is None else rows[top]
+            return [(int(snap.slot_ids[snap.row_slot[r]]), float(scores[i])) for i, r in zip(top, row_ids)]
+
+        # Multi-template: ambil row terbaik sebagai kandidat user, lalu fused score per user
+        top = _top_k(scores, k * self._max_templates * 2)
+        top = top[np.isfinite(scores[top])]
+        row_ids = top if rows is None else rows[top]
+        slots = list(dict.fromkeys(int(s) for s in snap.row_slot[row_ids]))
+        fused = self._fuse(snap, query, slots)
+        order = np.argsort(-fused, kind='stable')[:k]
+        return [(int(snap.slot_ids[slots[i]]), float(fused[i])) for i in order]
+
+    # --- GALLERY FILE (MEMMAP) ---
+    def load_file(self, gallery_file):
+        """
+        Maps every row of a GalleryFile. float32 galleries search the mapped rows as-is;
+        float16/int8 galleries map the file's quantized sidecar and keep the float32 rows
+        only as the rerank source. Either way the rows live in the shared page cache,
+        never in private memory.
+        """
+        with self._refresh_lock:
+            self._file, self._file_key = gallery_file, None
+        self.refresh()
+        print(f"[GALLERY] Mapped {len(self)} enrolled faces ({self._count} templates, {self.dtype}) from {gallery_file.path}.")
+
+    def refresh(self):
+        """
+        Catches up with rows appended or tombstoned in the gallery file (by any worker) since
+        the last call. One stat() when nothing changed; otherwise the file is re-mapped and
+        only the new tail rows are added to the slot table. Returns True when it changed.
+        """
+        gallery_file = self._file
+        if gallery_file is None:
+            return False
+        key = gallery_file.stat_key()
+        if key == self._file_key:
+            return False
+        with self._refresh_lock:
+            if key == self._file_key:
+                return False
+            rows, alive = gallery_file.rows()
+            if self.dtype == 'float32':
+                matrix, scales = rows['vec'], np.broadcast_to(np.float32(1.0), (len(rows),))
+            else:
+                matrix, scales = gallery_file.quantized(self.dtype)
+                matrix, scales = matrix[:len(rows)], scales[:len(rows)]
+            dead = np.flatnonzero(~alive) if alive is not None else np.zeros(0, dtype=np.int64)
+
+            # compact() bikin file baru (inode beda): nomor row berubah, slot table dibangun ulang
+            same_file = self._file_key is not None and self._file_key[0] == key[0] and len(rows) >= self._count
+            start = self._count if same_file else 0
+            ids = np.asarray(rows['user_id'][start:])
+            # Template satu user selalu di-append berurutan -> satu slot per run user_id
+            starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]]) if len(ids) else np.zeros(0, dtype=np.int64)
+            counts = np.diff(np.r_[starts, len(ids)]).astype(np.int64)
+
+            with self._lock:
+                if not same_file:
+                    self._reset(0, 0)
+                    self._ivf = None
+                n_slots = self._n_slots
+                slot_ids, slot_start, slot_count = ids[starts], starts + start, counts.copy()
+                if len(ids) and n_slots and self._slot_ids[n_slots - 1] == ids[0] \
+                        and self._slot_start[n_slots - 1] + self._slot_count[n_slots - 1] == start:
+                    # Lanjutan run user terakhir: slot itu diperpanjang (di copy, snapshot lama gak berubah)
+                    n_slots -= 1
+                    slot_start[0] = self._slot_start[n_slots]
+                    slot_count[0] += self._slot_count[n_slots]
+                    self._slot_count = self._slot_count.copy()
+
+                end_slot = n_slots + len(starts)
+                self._row_slot = self._grown(self._row_slot, len(rows))
+                self._row_slot[start:len(rows)] = np.repeat(np.arange(n_slots, end_slot, dtype=np.int64), counts)
+                self._slot_ids = self._grown(self._slot_ids, end_slot)
+                self._slot_start = self._grown(self._slot_start, end_slot)
+                self._slot_count = self._grown(self._slot_count, end_slot)
+                self._slot_ids[n_slots:end_slot] = slot_ids
+                self._slot_start[n_slots:end_slot] = slot_start
+                self._slot_count[n_slots:end_slot] = slot_count
+                self._assign = self._grown(self._assign, len(rows), fill=-1)
+                if self._ivf is not None and len(rows) > start:
+                    self._assign[start:len(rows)] = _assign_clusters(l2_normalize(matrix[start:len(rows)]),
+                                                                     self._ivf.centroids)
+
+                self._matrix, self._scales = matrix, scales
+                self._exact = rows['vec'] if self.rerank else None
+                self._dead = dead
+                self._dead_slots = len(np.unique(self._row_slot[dead]))
+                self._count, self._n_slots = len(rows), end_slot
+                if end_slot:
+                    self._max_templates = max(1, int(self._slot_count[:end_slot].max()))
+            self._file_key = key
+
+        if self._wants_ivf():
+            # Sama seperti add(): search tetap jalan pakai IVF lama / exact scan selama training
+            threading.Thread(target=self.train_ivf, daemon=True).start()
+        return True
@@ -0,0 +1,191 @@
+import time
+import secrets
+import sqlite3
+import threading
+from collections import deque
+
+from face_detection import box_iou
+
+
+class LatestFrameSlot:
+    """
+    Single-slot mailbox between the WebSocket reader and the face matcher.
+    put() overwrites whatever frame is still waiting, so when FaceNet falls
+    behind the old frames are dropped and only the newest one gets embedded.
+    """
+
+    def __init__(self):
+        self._frame = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self.received = 0
+        self.dropped = 0
+
+    def put(self, frame):
+        with self._cond:
+            if self._frame is not None:
+                self.dropped += 1
+            self._frame = frame
+            self.received += 1
+            self._cond.notify()
+
+    def take(self, timeout=None):
+        """Waits for the newest frame; returns None on timeout or once closed."""
+        with self._cond:
+            if self._frame is None and not self._closed:
+                self._cond.wait(timeout)
+            frame, self._frame = self._frame, None
+            return frame
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+
+LOGIN_TOKEN_TABLE = """
+CREATE TABLE IF NOT EXISTS login_tokens (
+    token TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    expires REAL NOT NULL
+);
+"""
+
+
+class LoginTokenStore:
+    """
+    One-time tokens handed out by the streaming login. A WebSocket can't set the
+    Flask session cookie, so the browser redeems the token over HTTP afterwards.
+    Tokens live in a SQLite (WAL) table, so any worker process can redeem them.
+    """
+
+    def __init__(self, path, ttl=30, purge_every=100):
+        self.path = path
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._issued = 0
+        self._local = threading.local()
+        self._conn().executescript(LOGIN_TOKEN_TABLE)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def issue(self, user_id):
+        token = secrets.token_urlsafe(32)
+        now = time.time()
+        self._conn().execute("INSERT INTO login_tokens (token, user_id, expires) VALUES (?, ?, ?)",
+                             (token, user_id, now + self.ttl))
+        self._issued += 1
+        if self._issued % self.purge_every == 0:
+            # Buang token kadaluarsa sekalian
+            self._conn().execute("DELETE FROM login_tokens WHERE expires < ?", (now,))
+        return token
+
+    def redeem(self, token):
+        """Returns the user id once per token, or None if unknown/expired."""
+        conn = self._conn()
+        row = conn.execute("SELECT user_id, expires FROM login_tokens WHERE token = ?", (token,)).fetchone()
+        if row is None:
+            return None
+        # Yang berhasil DELETE yang menang, jadi token gak bisa dipakai dua kali di worker berbeda
+        if conn.execute("DELETE FROM login_tokens WHERE token = ?", (token,)).rowcount != 1:
+            return None
+        if row[1] < time.time():
+            return None
+        return row[0]
+
+
+class LoginVoteWindow:
+    __slots__ = ('frames', 'last_box', 'skips', 'touched')
+
+    def __init__(self, size):
+        self.frames = deque(maxlen=size)   # tiap frame: {user_id: similarity}
+        self.last_box = None
+        self.skips = 0
+        self.touched = time.monotonic()
+
+
+class LoginVoter:
+    """
+    Multi-frame face login. Keeps the gallery candidates of the last `window`
+    embedded frames per scan session and counts, per user, the frames whose
+    similarity passed frame_threshold. Several consistent frames for the same
+    user can accept a face that no single frame scored above the login threshold.
+
+    Frames whose Haar box barely moved since the last embedded frame (IoU >= skip_iou)
+    are not embedded at all, up to max_skips in a row.
+    """
+
+    def __init__(self, window=5, frame_threshold=0.65, skip_iou=0.9, max_skips=2, ttl=10.0, max_sessions=10000):
+        self.window = window
+        self.frame_threshold = frame_threshold
+        self.skip_iou = skip_iou
+        self.max_skips = max_skips
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.frames_embedded = 0
+        self.frames_skipped = 0
+
+    def _get(self, client_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.get(client_id)
+            if entry is None or now - entry.touched > self.ttl:
+                if len(self._sessions) >= self.max_sessions:
+                    self._sessions = {k: v for k, v in self._sessions.items() if now - v.touched <= self.ttl}
+                entry = self._sessions[client_id] = LoginVoteWindow(self.window)
+            entry.touched = now
+            return entry
+
+    def should_skip(self, client_id, box):
+        """True when this frame's face box is practically the same as the last embedded one."""
+        entry = self._get(client_id)
+        if box is None or entry.last_box is None or entry.skips >= self.max_skips:
+            return False
+        if box_iou(box, entry.last_box) < self.skip_iou:
+            return False
+        entry.skips += 1
+        self.frames_skipped += 1
+        return True
+
+    def add(self, client_id, box, candidates):
+        """
+        Records one embedded frame's [(user_id, similarity)]. Returns (user_id, votes, mean similarity)
+        for the user with the most frames above frame_threshold, or (None, 0, 0.0).
+        """
+        entry = self._get(client_id)
+        entry.last_box = box
+        entry.skips = 0
+        entry.frames.append(dict(candidates))
+        self.frames_embedded += 1
+
+        hits = {}
+        for frame in entry.frames:
+            for user_id, similarity in frame.items():
+                if similarity > self.frame_threshold:
+                    hits.setdefault(user_id, []).append(similarity)
+        if not hits:
+            return None, 0, 0.0
+        # Seri jumlah frame -> total skor yang lebih tinggi
+        user_id, sims = max(hits.items(), key=lambda item: (len(item[1]), sum(item[1])))
+        return user_id, len(sims), sum(sims) / len(sims)
+
+    def reset(self, client_id):
+        with self._lock:
+            self._sessions.pop(client_id, None)
+
+    def stats(self):
+        return {"vote_sessions": len(self._sessions), "vote_frames_embedded": self.frames_embedded,
+                "vote_frames_skipped": self.frames_skipped}
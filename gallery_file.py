@@ -0,0 +1,269 @@
+import os
+import sys
+import fcntl
+import struct
+from contextlib import contextmanager
+
+import numpy as np
+
+from face_gallery import EMBEDDING_DIM, l2_normalize, quantize
+
+GALLERY_FILE = os.path.join('face_data', 'gallery.bin')
+GALLERY_MAGIC = b'HGFACE01'
+GALLERY_VERSION = 1
+HEADER = struct.Struct('<8sIIQQ')   # magic, version, dim, bitmap_rows, count
+HEADER_SIZE = 64
+DEFAULT_BITMAP_ROWS = 1 << 20       # 128 KB bitmap, cukup buat 1 juta template
+
+# Sidecar <path>.int8 / <path>.float16: row yang sama dalam bentuk quantized, urutannya 1:1 dengan file utama
+QUANT_MAGIC = b'HGQUANT1'
+QUANT_HEADER = struct.Struct('<8s8sIQQ')   # magic, dtype, dim, inode file utama, count
+QUANT_DTYPES = {'int8': '<i1', 'float16': '<f2'}
+
+
+def row_dtype(dim=EMBEDDING_DIM):
+    return np.dtype([('user_id', '<i8'), ('vec', '<f4', (dim,))])
+
+
+def quant_row_dtype(dtype, dim=EMBEDDING_DIM):
+    return np.dtype([('scale', '<f4'), ('vec', QUANT_DTYPES[dtype], (dim,))])
+
+
+class GalleryFile:
+    """
+    Append-only file holding every enrolled face template:
+
+        [64-byte header][tombstone bitmap, bitmap_rows bits][row 0][row 1]...
+
+    Rows are fixed width (user_id int64 + L2-normalized float32 x dim) and are never rewritten.
+    Deleting a user only sets its bits in the bitmap; compact() rewrites the file
+    without them. rows() maps the file with np.memmap, so every worker process
+    shares the same page cache. quantized() keeps an int8/float16 copy of the rows
+    (plus per-row scales) in a sidecar file that is mapped the same way.
+    """
+
+    def __init__(self, path=GALLERY_FILE, dim=EMBEDDING_DIM, bitmap_rows=DEFAULT_BITMAP_ROWS):
+        self.path = path
+        self.dim = dim
+        self.dtype = row_dtype(dim)
+        if not os.path.exists(path):
+            self._write_file(path, np.zeros(0, dtype=self.dtype), bitmap_rows)
+        with open(path, 'rb') as f:
+            self.bitmap_rows, self.count = self._read_header(f)
+
+    # --- FILE LAYOUT ---
+    def _read_header(self, f):
+        f.seek(0)
+        magic, version, dim, bitmap_rows, count = HEADER.unpack(f.read(HEADER.size))
+        if magic != GALLERY_MAGIC or version != GALLERY_VERSION:
+            raise ValueError(f"{self.path} is not a gallery file")
+        if dim != self.dim:
+            raise ValueError(f"{self.path} holds {dim}-d embeddings, expected {self.dim}")
+        return bitmap_rows, count
+
+    def _rows_offset(self, bitmap_rows):
+        return HEADER_SIZE + bitmap_rows // 8
+
+    def _write_file(self, path, rows, bitmap_rows):
+        # Tulis ke file sementara lalu os.replace: reader lama tetap pegang mapping file lama
+        bitmap_rows = -(-max(bitmap_rows, len(rows)) // 8) * 8
+        tmp = f"{path}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(GALLERY_MAGIC, GALLERY_VERSION, self.dim, bitmap_rows, len(rows)).ljust(HEADER_SIZE, b'\0'))
+            f.write(bytes(bitmap_rows // 8))
+            f.write(rows.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    @contextmanager
+    def _locked(self):
+        # Beberapa worker bisa append barengan; flock bikin urutannya aman
+        while True:
+            f = open(self.path, 'r+b')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # File bisa diganti compact() selagi nunggu lock -> buka ulang yang baru
+            if os.fstat(f.fileno()).st_ino == os.stat(self.path).st_ino:
+                break
+            f.close()
+        try:
+            yield f
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+    # --- WRITE ---
+    def _make_rows(self, user_id, embeddings):
+        embeddings = l2_normalize(np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim))
+        rows = np.zeros(len(embeddings), dtype=self.dtype)
+        rows['user_id'] = user_id
+        rows['vec'] = embeddings
+        return rows
+
+    def append(self, user_id, embeddings):
+        """Appends one user's templates (dim,) or (K, dim); returns the index of the first new row."""
+        return self._append_rows(self._make_rows(user_id, embeddings))
+
+    def _append_rows(self, rows):
+        with self._locked() as f:
+            bitmap_rows, count = self._read_header(f)
+            if count + len(rows) > bitmap_rows:
+                # Bitmap penuh: compact sekalian perbesar bitmap-nya
+                self._compact_locked(f, grow_to=count + len(rows))
+                return self._append_rows(rows)
+            f.seek(self._rows_offset(bitmap_rows) + count * self.dtype.itemsize)
+            f.write(rows.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+            # Count di header diupdate terakhir: row yang setengah ketulis gak pernah kebaca
+            f.seek(0)
+            f.write(HEADER.pack(GALLERY_MAGIC, GALLERY_VERSION, self.dim, bitmap_rows, count + len(rows)))
+            f.flush()
+        self.bitmap_rows, self.count = bitmap_rows, count + len(rows)
+        return count
+
+    def delete(self, user_id):
+        """Tombstones every row of user_id; returns how many rows were marked."""
+        with self._locked() as f:
+            bitmap_rows, count = self._read_header(f)
+            ids = np.memmap(f, dtype=self.dtype, mode='r', offset=self._rows_offset(bitmap_rows),
+                            shape=(count,))['user_id'] if count else np.zeros(0, dtype=np.int64)
+            dead = np.flatnonzero(ids == user_id)
+            if len(dead) == 0:
+                return 0
+            f.seek(HEADER_SIZE)
+            bitmap = np.frombuffer(f.read(bitmap_rows // 8), dtype=np.uint8).copy()
+            bits = np.unpackbits(bitmap, bitorder='little')
+            bits[dead] = 1
+            f.seek(HEADER_SIZE)
+            f.write(np.packbits(bits, bitorder='little').tobytes())
+            f.flush()
+        return len(dead)
+
+    def _compact_locked(self, f, grow_to=0):
+        bitmap_rows, count = self._read_header(f)
+        rows, alive = self._map(bitmap_rows, count, f)
+        kept = rows[alive] if alive is not None else np.array(rows)
+        new_bitmap_rows = max(DEFAULT_BITMAP_ROWS, bitmap_rows, 2 * max(len(kept), grow_to))
+        self._write_file(self.path, kept, new_bitmap_rows)
+        # Nomor row berubah: sidecar quantized dibangun ulang saat dibutuhkan
+        for dtype in QUANT_DTYPES:
+            if os.path.exists(self._quant_path(dtype)):
+                os.remove(self._quant_path(dtype))
+        self.bitmap_rows, self.count = new_bitmap_rows, len(kept)
+        return count, len(kept)
+
+    def compact(self):
+        """Rewrites the file without tombstoned rows; returns (rows before, rows after)."""
+        with self._locked() as f:
+            return self._compact_locked(f)
+
+    # --- READ ---
+    def _map(self, bitmap_rows, count, f):
+        if count == 0:
+            return np.zeros(0, dtype=self.dtype), None
+        # Map dari file object yang sama dengan header-nya (aman kalau file diganti compact())
+        rows = np.memmap(f, dtype=self.dtype, mode='r', offset=self._rows_offset(bitmap_rows), shape=(count,))
+        f.seek(HEADER_SIZE)
+        bitmap = np.frombuffer(f.read(-(-count // 8)), dtype=np.uint8)
+        dead = np.unpackbits(bitmap, bitorder='little')[:count].astype(bool)
+        return rows, (~dead if dead.any() else None)
+
+    def rows(self):
+        """Returns (rows, alive): a read-only memmap of all rows, and a bool mask or None when nothing is deleted."""
+        with open(self.path, 'rb') as f:
+            self.bitmap_rows, self.count = self._read_header(f)
+            return self._map(self.bitmap_rows, self.count, f)
+
+    def stat_key(self):
+        """Changes whenever rows are appended, tombstoned or the file is compacted."""
+        st = os.stat(self.path)
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    # --- QUANTIZED SIDECAR ---
+    def _quant_path(self, dtype):
+        return f"{self.path}.{dtype}"
+
+    def _quant_count(self, path, dtype, inode):
+        # Jumlah row yang sudah ada di sidecar, atau None kalau belum ada / punya file utama versi lain
+        try:
+            with open(path, 'rb') as q:
+                magic, stored, dim, source, count = QUANT_HEADER.unpack(q.read(QUANT_HEADER.size))
+        except (OSError, struct.error):
+            return None
+        if magic != QUANT_MAGIC or stored.rstrip(b'\0') != dtype.encode() or dim != self.dim or source != inode:
+            return None
+        return count
+
+    def quantized(self, dtype):
+        """
+        Returns (vec, scales): every row stored as int8/float16 with its per-row scale, memory-mapped
+        from the sidecar file. Rows appended since the last call are quantized into it first.
+        """
+        path, qdtype = self._quant_path(dtype), quant_row_dtype(dtype, self.dim)
+        with self._locked() as f:
+            bitmap_rows, count = self._read_header(f)
+            inode = os.fstat(f.fileno()).st_ino
+            done = self._quant_count(path, dtype, inode)
+            if done is None:
+                tmp = f"{path}.tmp"
+                with open(tmp, 'wb') as q:
+                    q.write(QUANT_HEADER.pack(QUANT_MAGIC, dtype.encode(), self.dim, inode, 0).ljust(HEADER_SIZE, b'\0'))
+                os.replace(tmp, path)
+                done = 0
+            if done < count:
+                source = np.memmap(f, dtype=self.dtype, mode='r', offset=self._rows_offset(bitmap_rows), shape=(count,))
+                with open(path, 'r+b') as q:
+                    # Sama seperti append(): row dulu, count di header terakhir
+                    q.seek(HEADER_SIZE + done * qdtype.itemsize)
+                    for start in range(done, count, 65536):
+                        block = np.asarray(source['vec'][start:min(count, start + 65536)])
+                        out = np.empty(len(block), dtype=qdtype)
+                        out['vec'], out['scale'] = quantize(block, dtype)
+                        q.write(out.tobytes())
+                    q.flush()
+                    os.fsync(q.fileno())
+                    q.seek(0)
+                    q.write(QUANT_HEADER.pack(QUANT_MAGIC, dtype.encode(), self.dim, inode, count))
+                    q.flush()
+            if count == 0:
+                return np.zeros((0, self.dim), dtype=QUANT_DTYPES[dtype]), np.zeros(0, dtype=np.float32)
+            # Row [0, count) gak pernah ditulis ulang, jadi mapping ini aman dipakai terus
+            rows = np.memmap(path, dtype=qdtype, mode='r', offset=HEADER_SIZE, shape=(count,))
+            return rows['vec'], rows['scale']
+
+    def user_ids(self):
+        rows, alive = self.rows()
+        ids = rows['user_id'] if alive is None else rows['user_id'][alive]
+        return set(int(i) for i in np.unique(ids))
+
+    # --- MIGRATION ---
+    def migrate_users(self, users):
+        """Ingests the per-user .npy files referenced by face_data_path; users already in the file are skipped."""
+        present = self.user_ids()
+        batches = []
+        for user in users:
+            path = user.get('face_data_path', '')
+            if user['id'] in present or not path or not os.path.exists(path):
+                continue
+            try:
+                batches.append(self._make_rows(user['id'], np.load(path)))
+            except Exception:
+                continue
+        if batches:
+            # Satu kali append (satu fsync) untuk semua user
+            self._append_rows(np.concatenate(batches))
+            print(f"[GALLERY] Migrated {len(batches)} per-user face files into {self.path}.")
+        return len(batches)
+
+
+if __name__ == "__main__":
+    # python gallery_file.py migrate | compact [path]
+    command = sys.argv[1] if len(sys.argv) > 1 else 'migrate'
+    gallery = GalleryFile(sys.argv[2] if len(sys.argv) > 2 else GALLERY_FILE)
+    if command == 'compact':
+        before, after = gallery.compact()
+        print(f"[GALLERY] Compacted {gallery.path}: {before} -> {after} rows.")
+    else:
+        from storage import Storage
+        gallery.migrate_users(Storage().list_users())
@@ -0,0 +1,75 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class BatchingEmbedder:
+    """
+    Micro-batching front for FaceNet.
+    Faces submitted by concurrent requests are collected for up to max_wait_ms
+    (or until max_batch_size is reached), embedded in one forward pass, and
+    each caller gets back its own row.
+    """
+
+    def __init__(self, embed_fn, max_batch_size=16, max_wait_ms=5):
+        self.embed_fn = embed_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self.batches_run = 0
+        self.faces_embedded = 0
+        self._worker = threading.Thread(target=self._run, name="facenet-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, face):
+        future = Future()
+        self._queue.put((np.expand_dims(face, axis=0), False, future))
+        return future
+
+    def submit_batch(self, faces):
+        # Satu grup frame (mis. dari batch enrollment) selalu masuk satu forward pass
+        future = Future()
+        self._queue.put((np.stack(faces), True, future))
+        return future
+
+    def embed(self, face, timeout=None):
+        return self.submit(face).result(timeout=timeout)
+
+    def embed_many(self, faces, timeout=None):
+        if len(faces) == 0:
+            return np.empty((0, 0), dtype=np.float32)
+        return self.submit_batch(faces).result(timeout=timeout)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        rows = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while rows < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            rows += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                embeddings = self.embed_fn(np.concatenate([faces for faces, _, _ in batch]))
+            except Exception as e:
+                for _, _, f in batch:
+                    f.set_exception(e)
+                continue
+            self.batches_run += 1
+            self.faces_embedded += len(embeddings)
+            offset = 0
+            for faces, is_group, f in batch:
+                rows = embeddings[offset:offset + len(faces)]
+                offset += len(faces)
+                f.set_result(rows if is_group else rows[0])
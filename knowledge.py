@@ -0,0 +1,104 @@
+import os
+import json
+import time
+import threading
+
+from diagnosis import DiagnosisEngine
+from chat_flow import ChatFlowMachine
+from doctor_index import DoctorIndex
+
+KNOWLEDGE_FILE = 'database.json'
+RELOAD_CHECK_INTERVAL = 5.0  # seconds between mtime checks
+
+
+class FrozenDict(dict):
+    """A dict that refuses mutation. Still serializes like a normal dict."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Knowledge base is read-only")
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+
+def freeze(obj):
+    if isinstance(obj, dict):
+        return FrozenDict((k, freeze(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+class KnowledgeBase:
+    """
+    Immutable snapshot of medical_knowledge (flows, diseases, doctors, medicines).
+    Shared by every request; callers copy a node before changing it.
+    """
+
+    def __init__(self, data, version):
+        self.version = version
+        self.flows = freeze(data.get('flows', {}))
+        self.diseases = freeze(data.get('diseases', []))
+        self.doctors = freeze(data.get('doctors', []))
+        self.medicines = freeze(data.get('medicines', []))
+        self.specialties = tuple(sorted(set(d['specialty'] for d in self.doctors)))
+
+        # Compiled once per version, shared by every consultation
+        self.diagnosis = DiagnosisEngine(self.diseases)
+        self.flow_machine = ChatFlowMachine(self.flows)
+        self.doctor_index = DoctorIndex(self.doctors)
+
+
+class KnowledgeLoader:
+    """
+    Loads the knowledge base once per process and hot-reloads it when the
+    source file's mtime/size changes (checked at most every check_interval seconds).
+    """
+
+    def __init__(self, path=KNOWLEDGE_FILE, check_interval=RELOAD_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._kb = None
+        self._last_check = 0.0
+        self.reload()
+
+    def _file_version(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return 'empty'
+        return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+    def reload(self):
+        version = self._file_version()
+        data = {}
+        if version != 'empty':
+            with open(self.path, 'r') as f:
+                try:
+                    data = json.load(f).get('medical_knowledge', {})
+                except json.JSONDecodeError:
+                    # File lagi ditulis db_setup.py; pakai versi lama, coba lagi nanti
+                    if self._kb is not None:
+                        return self._kb
+        kb = KnowledgeBase(data, version)
+        with self._lock:
+            self._kb = kb
+            self._last_check = time.monotonic()
+        print(f"[KNOWLEDGE] Loaded version {version}: {len(kb.doctors)} doctors, {len(kb.diseases)} diseases.")
+        return kb
+
+    def get(self):
+        kb = self._kb
+        if self.check_interval is None:
+            return kb
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return kb
+        with self._lock:
+            if now - self._last_check < self.check_interval:
+                return self._kb
+            self._last_check = now
+        if self._file_version() != kb.version:
+            return self.reload()
+        return kb
@@ -0,0 +1,177 @@
+import time
+import secrets
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+SESSION_TABLE = """
+CREATE TABLE IF NOT EXISTS web_sessions (
+    sid TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_web_sessions_expires ON web_sessions(expires);
+"""
+
+
+class MemorySessionBackend:
+    """In-process LRU + TTL store. Fastest, but only valid for a single worker process."""
+
+    def __init__(self, ttl=7 * 24 * 3600, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None:
+                return None
+            if now - entry[1] > self.ttl:
+                del self._entries[sid]
+                return None
+            # Sliding expiry: dipakai -> umurnya diperpanjang
+            self._entries[sid] = (entry[0], now)
+            self._entries.move_to_end(sid)
+            return entry[0]
+
+    def set(self, sid, data):
+        with self._lock:
+            self._entries[sid] = (data, time.monotonic())
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def touch(self, sid):
+        pass   # get() sudah memperpanjang
+
+    def delete(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+
+
+class SQLiteSessionBackend:
+    """
+    Sessions in a SQLite (WAL) table, shared by every worker process on the host.
+    Expiry slides, but is only rewritten once half of the TTL has passed.
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600, purge_every=1000):
+        self.path = path
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._writes = 0
+        self._local = threading.local()
+        self._conn().executescript(SESSION_TABLE)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, sid):
+        row = self._conn().execute("SELECT data, expires FROM web_sessions WHERE sid = ?", (sid,)).fetchone()
+        if row is None:
+            return None
+        if row[1] < time.time():
+            self.delete(sid)
+            return None
+        return row[0]
+
+    def set(self, sid, data):
+        self._conn().execute("INSERT OR REPLACE INTO web_sessions (sid, data, expires) VALUES (?, ?, ?)",
+                             (sid, data, time.time() + self.ttl))
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            self._conn().execute("DELETE FROM web_sessions WHERE expires < ?", (time.time(),))
+
+    def touch(self, sid):
+        now = time.time()
+        self._conn().execute("UPDATE web_sessions SET expires = ? WHERE sid = ? AND expires < ?",
+                             (now + self.ttl, sid, now + self.ttl / 2))
+
+    def delete(self, sid):
+        self._conn().execute("DELETE FROM web_sessions WHERE sid = ?", (sid,))
+
+
+def new_sid():
+    return secrets.token_urlsafe(32)
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.previous_sid = None
+
+    def regenerate(self):
+        """Moves the data to a fresh session id; the old id is deleted when the response is saved."""
+        if not self.new and self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = new_sid()
+        self.new = True
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    """
+    Flask session kept server side in a backend (MemorySessionBackend / SQLiteSessionBackend).
+    The cookie only carries a random session id, so requests stop shipping and
+    re-signing the whole chat state, and Set-Cookie is only sent when the id is new.
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.backend.get(sid)
+            if data is not None:
+                return ServerSession(self.serializer.loads(data), sid=sid)
+        return ServerSession(sid=new_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.previous_sid is not None:
+            # Id lama (sebelum login/logout) gak boleh bisa dipakai lagi: cegah session fixation
+            self.backend.delete(session.previous_sid)
+
+        if not session:
+            # session.clear() (logout): hapus di backend dan di browser
+            if session.modified and not session.new:
+                self.backend.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            elif session.previous_sid is not None:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.modified or session.new:
+            self.backend.set(session.sid, self.serializer.dumps(dict(session)))
+        else:
+            self.backend.touch(session.sid)
+
+        if session.new:
+            response.vary.add("Cookie")
+            response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                                secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
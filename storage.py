@@ -0,0 +1,317 @@
+import os
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+SQLITE_FILE = 'healthguard.db'
+LEGACY_JSON_FILE = 'database.json'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    email TEXT,
+    phone TEXT,
+    password TEXT,
+    face_data_path TEXT,
+    rev INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
+CREATE INDEX IF NOT EXISTS idx_users_phone ON users(phone);
+
+CREATE TABLE IF NOT EXISTS chat_sessions (
+    session_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    title TEXT,
+    timestamp TEXT,
+    state TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS idx_chat_sessions_user ON chat_sessions(user_id);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL REFERENCES chat_sessions(session_id) ON DELETE CASCADE,
+    sender TEXT,
+    text TEXT,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, id);
+
+CREATE TABLE IF NOT EXISTS reminders (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    medicine TEXT,
+    instruction TEXT,
+    start_date TEXT,
+    end_date TEXT,
+    times TEXT NOT NULL DEFAULT '[]',
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_reminders_user ON reminders(user_id);
+
+CREATE TABLE IF NOT EXISTS appointments (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    doctor_name TEXT,
+    doctor_specialty TEXT,
+    doctor_image TEXT,
+    hospital TEXT,
+    price INTEGER,
+    date TEXT,
+    time TEXT,
+    status TEXT,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_appointments_user ON appointments(user_id);
+"""
+
+USER_FIELDS = ('id', 'name', 'email', 'phone', 'password', 'face_data_path')
+REMINDER_FIELDS = ('id', 'user_id', 'medicine', 'instruction', 'start_date', 'end_date', 'times', 'created_at')
+APPOINTMENT_FIELDS = ('id', 'user_id', 'doctor_name', 'doctor_specialty', 'doctor_image', 'hospital',
+                      'price', 'date', 'time', 'status', 'created_at')
+
+
+class Storage:
+    """
+    SQLite (WAL mode) store for users, chat sessions, messages, reminders and appointments.
+    Every method is a small keyed query, so no request rewrites the whole database.
+    """
+
+    def __init__(self, path=SQLITE_FILE):
+        self.path = path
+        self._local = threading.local()
+        self._conn().executescript(SCHEMA)
+        self._upgrade()
+
+    def _upgrade(self):
+        # DB lama belum punya kolom users.rev
+        columns = {row['name'] for row in self._conn().execute("PRAGMA table_info(users)")}
+        if 'rev' not in columns:
+            self._conn().execute("ALTER TABLE users ADD COLUMN rev INTEGER NOT NULL DEFAULT 0")
+        self._conn().execute("CREATE INDEX IF NOT EXISTS idx_users_rev ON users(rev)")
+
+    # --- CONNECTION ---
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _one(self, sql, params=()):
+        row = self._conn().execute(sql, params).fetchone()
+        return dict(row) if row else None
+
+    def _all(self, sql, params=()):
+        return [dict(row) for row in self._conn().execute(sql, params).fetchall()]
+
+    # --- USERS ---
+    # Setiap insert/update user menaikkan meta.users_rev dan menandai row-nya dengan rev itu,
+    # jadi cache user di proses lain cukup ambil row dengan rev > rev terakhir yang dia lihat.
+    def _bump_users_rev(self, conn):
+        conn.execute("INSERT INTO meta (key, value) VALUES ('users_rev', 1) "
+                     "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+        return int(conn.execute("SELECT value FROM meta WHERE key = 'users_rev'").fetchone()[0])
+
+    def users_rev(self):
+        row = self._one("SELECT value FROM meta WHERE key = 'users_rev'")
+        return int(row['value']) if row else 0
+
+    def list_users(self):
+        return self._all("SELECT * FROM users ORDER BY id")
+
+    def list_users_since(self, rev):
+        return self._all("SELECT * FROM users WHERE rev > ? ORDER BY id", (rev,))
+
+    def get_user(self, user_id):
+        return self._one("SELECT * FROM users WHERE id = ?", (user_id,))
+
+    def get_user_by_email(self, email):
+        return self._one("SELECT * FROM users WHERE email = ? ORDER BY id LIMIT 1", (email,))
+
+    def get_user_by_phone(self, phone):
+        return self._one("SELECT * FROM users WHERE phone = ? ORDER BY id LIMIT 1", (phone,))
+
+    def insert_user(self, user):
+        fields = [f for f in USER_FIELDS if f in user]
+        with self.transaction() as conn:
+            rev = self._bump_users_rev(conn)
+            cur = conn.execute(
+                f"INSERT INTO users ({', '.join(fields)}, rev) VALUES ({', '.join('?' * len(fields))}, ?)",
+                [user[f] for f in fields] + [rev])
+            return cur.lastrowid
+
+    def update_user(self, user_id, **fields):
+        fields = {k: v for k, v in fields.items() if k in USER_FIELDS and k != 'id'}
+        if not fields:
+            return False
+        assignments = ', '.join(f"{k} = ?" for k in fields)
+        with self.transaction() as conn:
+            rev = self._bump_users_rev(conn)
+            cur = conn.execute(f"UPDATE users SET {assignments}, rev = ? WHERE id = ?", [*fields.values(), rev, user_id])
+            return cur.rowcount > 0
+
+    # --- REMINDERS ---
+    def list_reminders(self, user_id):
+        rows = self._all("SELECT * FROM reminders WHERE user_id = ? ORDER BY rowid", (user_id,))
+        for r in rows:
+            r['times'] = json.loads(r['times'])
+        return rows
+
+    def add_reminder(self, reminder):
+        values = [reminder.get(f) for f in REMINDER_FIELDS]
+        values[REMINDER_FIELDS.index('times')] = json.dumps(reminder.get('times', []))
+        with self.transaction() as conn:
+            conn.execute(f"INSERT INTO reminders VALUES ({', '.join('?' * len(REMINDER_FIELDS))})", values)
+
+    def update_reminder(self, reminder_id, user_id, instruction, times):
+        with self.transaction() as conn:
+            cur = conn.execute(
+                "UPDATE reminders SET instruction = ?, times = ? WHERE id = ? AND user_id = ?",
+                (instruction, json.dumps(times), reminder_id, user_id))
+            return cur.rowcount > 0
+
+    def delete_reminder(self, reminder_id, user_id):
+        with self.transaction() as conn:
+            cur = conn.execute("DELETE FROM reminders WHERE id = ? AND user_id = ?", (reminder_id, user_id))
+            return cur.rowcount > 0
+
+    # --- APPOINTMENTS ---
+    def list_appointments(self, user_id):
+        return self._all("SELECT * FROM appointments WHERE user_id = ? ORDER BY rowid", (user_id,))
+
+    def add_appointment(self, appointment):
+        with self.transaction() as conn:
+            conn.execute(f"INSERT INTO appointments VALUES ({', '.join('?' * len(APPOINTMENT_FIELDS))})",
+                         [appointment.get(f) for f in APPOINTMENT_FIELDS])
+
+    def delete_appointment(self, appointment_id, user_id):
+        with self.transaction() as conn:
+            cur = conn.execute("DELETE FROM appointments WHERE id = ? AND user_id = ?", (appointment_id, user_id))
+            return cur.rowcount > 0
+
+    # --- CHAT SESSIONS ---
+    def list_chat_sessions(self, user_id, newest_first=True):
+        order = 'DESC' if newest_first else 'ASC'
+        return self._all(
+            f"SELECT session_id, user_id, title, timestamp FROM chat_sessions WHERE user_id = ? ORDER BY rowid {order}",
+            (user_id,))
+
+    def get_chat_session(self, session_id, user_id=None):
+        sql = "SELECT * FROM chat_sessions WHERE session_id = ?"
+        params = [session_id]
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            params.append(user_id)
+        s = self._one(sql, params)
+        if s is None:
+            return None
+        s['state'] = json.loads(s['state'])
+        s['messages'] = []
+        for m in self._all("SELECT sender, text, data FROM messages WHERE session_id = ? ORDER BY id", (session_id,)):
+            msg = {"sender": m['sender'], "text": m['text']}
+            if m['data'] is not None:
+                msg['data'] = json.loads(m['data'])
+            s['messages'].append(msg)
+        return s
+
+    @staticmethod
+    def _insert_message(conn, session_id, msg):
+        data = json.dumps(msg['data']) if 'data' in msg else None
+        conn.execute("INSERT INTO messages (session_id, sender, text, data) VALUES (?, ?, ?, ?)",
+                     (session_id, msg.get('sender'), msg.get('text'), data))
+
+    def record_turn(self, session_id, messages, state=None, title=None, only_if_title=None, new_session=None):
+        """
+        Persists one chat turn in a single transaction: optional session creation, message
+        appends and keyed state/title writes. The transcript itself is never read.
+        title is only applied while the current title equals only_if_title (when given).
+        Returns False if the session does not exist (e.g. deleted from history).
+        """
+        with self.transaction() as conn:
+            if new_session is not None:
+                conn.execute(
+                    "INSERT INTO chat_sessions (session_id, user_id, title, timestamp, state) VALUES (?, ?, ?, ?, ?)",
+                    (session_id, new_session['user_id'], new_session.get('title'), new_session.get('timestamp'),
+                     json.dumps(new_session.get('state', {}))))
+            cur = conn.execute("UPDATE chat_sessions SET state = COALESCE(?, state) WHERE session_id = ?",
+                               (json.dumps(state) if state is not None else None, session_id))
+            if cur.rowcount == 0:
+                return False
+            if title is not None:
+                conn.execute("UPDATE chat_sessions SET title = ? WHERE session_id = ? AND (? IS NULL OR title = ?)",
+                             (title, session_id, only_if_title, only_if_title))
+            for msg in messages:
+                self._insert_message(conn, session_id, msg)
+        return True
+
+    def delete_chat_session(self, session_id, user_id):
+        with self.transaction() as conn:
+            cur = conn.execute("DELETE FROM chat_sessions WHERE session_id = ? AND user_id = ?", (session_id, user_id))
+            return cur.rowcount > 0
+
+    # --- MIGRATION ---
+    def migrate_from_json(self, json_path=LEGACY_JSON_FILE, force=False):
+        """
+        One-shot import of users, chats, reminders and appointments from the old database.json.
+        """
+        if not os.path.exists(json_path):
+            return False
+        if not force and self._one("SELECT value FROM meta WHERE key = 'migrated_from_json'"):
+            return False
+
+        with open(json_path, 'r') as f:
+            try:
+                data = json.load(f)
+            except json.JSONDecodeError:
+                return False
+
+        with self.transaction() as conn:
+            rev = self._bump_users_rev(conn)
+            for user in data.get('users', []):
+                conn.execute(f"INSERT OR IGNORE INTO users ({', '.join(USER_FIELDS)}, rev) VALUES ({', '.join('?' * len(USER_FIELDS))}, ?)",
+                             [user.get(f) for f in USER_FIELDS] + [rev])
+            for s in data.get('chat_sessions', []):
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO chat_sessions (session_id, user_id, title, timestamp, state) VALUES (?, ?, ?, ?, ?)",
+                    (s['session_id'], s['user_id'], s.get('title'), s.get('timestamp'), json.dumps(s.get('state', {}))))
+                if cur.rowcount:
+                    for msg in s.get('messages', []):
+                        self._insert_message(conn, s['session_id'], msg)
+            for r in data.get('reminders', []):
+                values = [r.get(f) for f in REMINDER_FIELDS]
+                values[REMINDER_FIELDS.index('times')] = json.dumps(r.get('times', []))
+                conn.execute(f"INSERT OR IGNORE INTO reminders VALUES ({', '.join('?' * len(REMINDER_FIELDS))})", values)
+            for a in data.get('appointments', []):
+                conn.execute(f"INSERT OR IGNORE INTO appointments VALUES ({', '.join('?' * len(APPOINTMENT_FIELDS))})",
+                             [a.get(f) for f in APPOINTMENT_FIELDS])
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from_json', ?)", (json_path,))
+
+        print(f"[MIGRATION] Imported {len(data.get('users', []))} users and "
+              f"{len(data.get('chat_sessions', []))} chat sessions from {json_path}.")
+        return True
+
+
+if __name__ == "__main__":
+    Storage().migrate_from_json(force=True)
@@ -0,0 +1,100 @@
+import threading
+
+from flask import g, has_request_context
+
+
+class UserRepository:
+    """
+    In-process user directory on top of Storage with hash indexes by id, email and phone.
+
+    Indexes are updated directly on insert()/update(). Writes from other worker
+    processes are picked up through Storage.users_rev(): when the revision moved,
+    only the changed rows are re-read. Inside a Flask request that check runs at
+    most once (flag in flask.g), so a request never queries the users table twice.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._by_id = {}
+        self._by_email = {}
+        self._by_phone = {}
+        self._rev = None
+        self._lock = threading.Lock()
+
+    # --- INDEX ---
+    def _index(self, user):
+        old = self._by_id.get(user['id'])
+        if old is not None:
+            for index, key in ((self._by_email, old.get('email')), (self._by_phone, old.get('phone'))):
+                if index.get(key) == user['id']:
+                    del index[key]
+        self._by_id[user['id']] = user
+        # Sama seperti get_user_by_email: kalau dobel, menang id terkecil
+        for index, key in ((self._by_email, user.get('email')), (self._by_phone, user.get('phone'))):
+            if key is not None and (key not in index or user['id'] < index[key]):
+                index[key] = user['id']
+
+    def sync(self):
+        """Applies user rows written (by any process) since the last sync."""
+        rev = self.store.users_rev()
+        with self._lock:
+            if rev == self._rev:
+                return
+            rows = self.store.list_users() if self._rev is None else self.store.list_users_since(self._rev)
+            for user in rows:
+                self._index(user)
+            self._rev = rev
+
+    def _fresh(self):
+        if not has_request_context():
+            self.sync()
+        elif not g.get('_users_synced'):
+            self.sync()
+            g._users_synced = True
+
+    # --- LOOKUPS ---
+    def get(self, user_id):
+        self._fresh()
+        user = self._by_id.get(user_id)
+        return dict(user) if user else None
+
+    def _get_by(self, index, load, value):
+        self._fresh()
+        user_id = index.get(value)
+        if user_id is None:
+            # Miss jarang (cek registrasi / email salah): pastikan ke DB, misal email yang dipakai 2 user
+            user = load(value)
+            if user is None:
+                return None
+            with self._lock:
+                self._index(user)
+            user_id = user['id']
+        return self.get(user_id)
+
+    def get_by_email(self, email):
+        return self._get_by(self._by_email, self.store.get_user_by_email, email)
+
+    def get_by_phone(self, phone):
+        return self._get_by(self._by_phone, self.store.get_user_by_phone, phone)
+
+    def list(self):
+        self._fresh()
+        return [dict(self._by_id[user_id]) for user_id in sorted(self._by_id)]
+
+    # --- WRITES ---
+    def insert(self, user):
+        user_id = self.store.insert_user(user)
+        self.refresh(user_id)
+        return user_id
+
+    def update(self, user_id, **fields):
+        updated = self.store.update_user(user_id, **fields)
+        if updated:
+            self.refresh(user_id)
+        return updated
+
+    def refresh(self, user_id):
+        user = self.store.get_user(user_id)
+        if user is not None:
+            with self._lock:
+                self._index(user)
@@ -0,0 +1,151 @@
+import threading
+import time
+import numpy as np
+
+from inference import BatchingEmbedder
+
+
+class VisionUnavailable(Exception):
+    pass
+
+
+class VisionBusy(VisionUnavailable):
+    pass
+
+
+class FaceVision:
+    """
+    Lazily loaded FaceNet stack.
+    TensorFlow/keras_facenet is only imported on the first embedding request
+    (or by warm_up() in the background), so non-vision routes start instantly.
+    With enabled=False the model is never loaded and face calls raise VisionUnavailable.
+
+    backend:
+      'thread'  - FaceNet in this process behind the micro-batching thread (default)
+      'process' - pool of worker processes, each with its own FaceNet (embedding_service.py)
+      'remote'  - shared embedding service on a UNIX socket (python embedding_service.py)
+    """
+
+    def __init__(self, enabled=True, batch_size=16, batch_wait_ms=5, backend='thread',
+                 workers=2, queue_size=64, timeout=5.0, socket_path=None):
+        self.enabled = enabled
+        self.backend = backend
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.socket_path = socket_path
+        self.batch_size = batch_size
+        self.batch_wait_ms = batch_wait_ms
+        self.state = 'cold' if enabled else 'disabled'
+        self.error = None
+        self.load_seconds = None
+        self.embedder = None
+        self.batcher = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self.batcher is not None:
+                return self.batcher
+            if not self.enabled:
+                raise VisionUnavailable("Vision is disabled on this worker")
+
+            self.state = 'loading'
+            started = time.monotonic()
+            if self.backend != 'thread':
+                return self._load_service(started)
+            print("[SYSTEM] Loading FaceNet (State-of-the-art Face Recognition)...")
+            try:
+                # Import di sini supaya TensorFlow gak ikut ke-load waktu startup
+                from keras_facenet import FaceNet
+                # Ini akan mendownload model FaceNet sekali saja (sekitar 90MB)
+                self.embedder = FaceNet()
+            except Exception as e:
+                self.state = 'failed'
+                self.error = str(e)
+                print(f"[SYSTEM] FaceNet failed to load: {e}")
+                raise VisionUnavailable(self.error)
+
+            self.batcher = BatchingEmbedder(self.embedder.embeddings, max_batch_size=self.batch_size,
+                                            max_wait_ms=self.batch_wait_ms)
+            self.load_seconds = time.monotonic() - started
+            self.state = 'ready'
+            print(f"[SYSTEM] FaceNet Loaded in {self.load_seconds:.1f}s. AI Vision System Active.")
+            return self.batcher
+
+    def _load_service(self, started):
+        from embedding_service import EmbeddingProcessPool, EmbeddingServiceClient, EMBED_SOCKET
+        try:
+            if self.backend == 'process':
+                print(f"[SYSTEM] Starting {self.workers} FaceNet worker processes...")
+                service = EmbeddingProcessPool(workers=self.workers, queue_size=self.queue_size,
+                                               timeout=self.timeout, max_batch=self.batch_size)
+            else:
+                service = EmbeddingServiceClient(self.socket_path or EMBED_SOCKET)
+        except Exception as e:
+            self.state = 'failed'
+            self.error = str(e)
+            print(f"[SYSTEM] Embedding service unavailable: {e}")
+            raise VisionUnavailable(self.error)
+
+        self.batcher = service
+        self.load_seconds = time.monotonic() - started
+        self.state = 'ready' if service.ready else 'loading'
+        return self.batcher
+
+    @property
+    def ready(self):
+        if self.state == 'loading' and self.batcher is not None and self.batcher.ready:
+            self.state = 'ready'
+        return self.state == 'ready'
+
+    def get_batcher(self):
+        return self.batcher if self.batcher is not None else self._load()
+
+    def warm_up(self):
+        """Loads the model (and runs one dummy pass) in a background thread."""
+        if not self.enabled:
+            return None
+
+        def _run():
+            try:
+                self.get_batcher().embed(np.zeros((160, 160, 3), dtype=np.uint8))
+            except Exception:
+                pass
+
+        thread = threading.Thread(target=_run, name="facenet-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def embed(self, face):
+        return self._call('embed', face)
+
+    def embed_many(self, faces):
+        return self._call('embed_many', faces)
+
+    def _call(self, method, arg):
+        service = self.get_batcher()
+        if self.backend == 'thread':
+            return getattr(service, method)(arg)
+        from embedding_service import EmbeddingServiceBusy, EmbeddingServiceError
+        try:
+            return getattr(service, method)(arg)
+        except EmbeddingServiceBusy as e:
+            raise VisionBusy(str(e))
+        except EmbeddingServiceError as e:
+            raise VisionUnavailable(str(e))
+
+    def status(self):
+        ready = self.ready
+        info = {"enabled": self.enabled, "state": self.state, "ready": ready}
+        if self.load_seconds is not None:
+            info["load_seconds"] = round(self.load_seconds, 2)
+        info["backend"] = self.backend
+        if self.batcher is not None and self.backend == 'thread':
+            info["batches_run"] = self.batcher.batches_run
+            info["faces_embedded"] = self.batcher.faces_embedded
+        elif self.batcher is not None:
+            info.update(self.batcher.stats())
+        if self.error:
+            info["error"] = self.error
+        return info